@@ -1,13 +1,20 @@
 import logging
 import socket
+import select
+import sys
+import time
 import tempfile
 import json
 import hashlib
+import struct
+import zlib
 import re
 
+from array import array
 from collections import defaultdict
 
 from pymol import cmd
+from pymol import cgo
 from pymol.cgo import *
 from pymol import stored
 
@@ -167,44 +174,62 @@ VCONTACTS                       2019-05-31
         )
 
 
-    query = json.dumps({
+    query = {
         'filter': Vfilter,
         'params': params
-    })
+    }
 
     try:
-        # Create TCP client obj
-        client = TCPClient(host, port)
-        # Start TCP client
-        client.start()
+        # Connection kept from previous calls or a new one
+        client, reused = get_client(host, port)
+    except socket.timeout as e:
+        logging.error("Connection time out.")
+        return
+    except ServerBusyErr as e:
+        logging.error("Server is busy. Try again later.")
+        return
     except Exception as e:
         logging.critical(e)
         logging.info('Server might not be running')
         return
 
     try:
-        # Check if server has PDB file
-        if not client.check_file(model):
-            client.send_file(model)
+        if client.version >= 2:
+            data = query_server(client, reused, host, port, model, query)
+        else:
+            try:
+                # Check if server has PDB file
+                if not client.check_file(model):
+                    client.send_file(model)
 
-        cgo_path = client.get_cgo(model, query)
+                data = client.get_cgo(model, query)
+            finally:
+                client.close()
 
     except socket.timeout as e:
         logging.error("Connection time out.")
         return
+    except ServerBusyErr as e:
+        logging.error("Server is busy. Try again later.")
+        return
     except Exception as e:
         logging.error("Server side error")
         return
 
-    del client
+    summary(data['summary'])
 
     # draw CGOs
-    draw_CGO(cgo_path)
+    if 'cgo' in data:
+        load_CGO(data)
+    else:
+        draw_CGO(data['path'])
 
     return
 
 
 stored._vcontacts_id = 1
+# (host, port) -> TCPClient kept connected between calls
+stored._vcontacts_clients = getattr(stored, '_vcontacts_clients', dict())
 cmd.extend('Vcontacts', Vcontacts)
 selections_ = lambda: cmd.Shortcut(cmd.get_names('selections'))
 cmd.auto_arg[0]['Vcontacts'] = [selections_, 'left side selections', ', ']
@@ -225,13 +250,33 @@ class CallCounter:
 
 class TimeOutErr(Exception): pass
 
+class ServerBusyErr(Exception): pass
+
+class ConnectionLostErr(Exception): pass
+
 class TCPClient:
     '''TCP client'''
 
     # CONSTANTS
     RESP_OK   = 'OK'
+    RESP_BUSY = 'BUSY'
     CHECKFILE = 'CHECKFILE '
     SENDFILE  = 'SENDFILE '
+    HELLO     = 'HELLO '
+
+    LOCAL_HOSTS = ('127.0.0.1', 'localhost', '::1')
+    # Smaller structures are sent whole
+    CHUNKED_UPLOAD_MIN = 256 * 1024
+
+    # Framed protocol
+    PROTOCOL_VERSION = 2
+    FRAME_HEADER = struct.Struct('!II')
+
+    # 10 minutes for timeout
+    TIMEOUT = 600
+    # Kept connections idle for longer are pinged before reuse
+    PING_AFTER = 30
+    PING_TIMEOUT = 5
 
     def __init__(self, host, port):
         try:
@@ -240,6 +285,13 @@ class TCPClient:
             raise ValueError("Port number must be numeric.")
         self._bufferSize = 8192
         self._socket = None
+        # Negotiated protocol version and server features
+        self.version = 1
+        self.features = []
+        self._last_id = 0
+        # Framed responses received ahead of time, by request id
+        self._responses = dict()
+        self._last_used = time.time()
 
     def send(self, request, encode=True):
         if encode:
@@ -253,12 +305,18 @@ class TCPClient:
         return self._socket.recv(self._bufferSize)
 
     def start(self):
+        """Function for connecting to server and negotiating protocol"""
+        self.connect()
+        self.hello()
+
+    def connect(self):
         """Function for initializing client socket and connecting to server"""
         # create socket
         try:
             self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            # 10 minutes for timeout
-            self._socket.settimeout(600)
+            self._socket.settimeout(self.TIMEOUT)
+            # connection is kept between calls
+            self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
         except socket.error as msg:
             logging.error("Can't create socket. Error code: {}, msg: {}".format(*msg))
             raise
@@ -270,11 +328,189 @@ class TCPClient:
             logging.error("Can't connect to the server on {}:{}".format(*self.address))
             raise
 
+    def hello(self):
+        """Switches to framed protocol if server supports it"""
+        self.send(self.HELLO + str(self.PROTOCOL_VERSION))
+        srv_resp = self.recieve()
+
+        if srv_resp == self.RESP_BUSY:
+            raise ServerBusyErr()
+
+        srv_resp = srv_resp.split(' ')
+        if srv_resp[0] == self.RESP_OK:
+            self.version = int(srv_resp[1])
+            if len(srv_resp) > 2:
+                self.features = srv_resp[2].split(',')
+            return
+
+        # Old servers close connection after unknown request
+        logging.debug("Server does not support framed protocol")
+        self._socket.close()
+        self.connect()
+
+    def recieve_exactly(self, size):
+        """Receives size bytes straight into one buffer"""
+        data = bytearray(size)
+        view = memoryview(data)
+        received = 0
+        while received < size:
+            count = self._socket.recv_into(view[received:])
+            if not count:
+                raise ConnectionLostErr("Connection closed by server")
+            received += count
+        return data
+
+    def submit(self, meta, payload=b''):
+        """Sends framed request without waiting for response.
+        Returns request id"""
+        self._last_id += 1
+        meta = dict(meta, id=self._last_id)
+        encoded = json.dumps(meta).encode()
+        self._socket.sendall(
+            self.FRAME_HEADER.pack(len(encoded), len(payload)) + encoded)
+        if payload:
+            self._socket.sendall(payload)
+        return self._last_id
+
+    def collect(self, ids):
+        """Returns (meta, payload) responses for given request ids"""
+        while not all(i in self._responses for i in ids):
+            header = self.recieve_exactly(self.FRAME_HEADER.size)
+            meta_size, payload_size = self.FRAME_HEADER.unpack(header)
+            meta = json.loads(bytes(self.recieve_exactly(meta_size)).decode())
+            payload = self.recieve_exactly(payload_size)
+            self._responses[meta['id']] = (meta, payload)
+        self._last_used = time.time()
+        return [self._responses.pop(i) for i in ids]
+
+    def alive(self):
+        """Health check of kept connection. Connection closed by server is
+        noticed without a round trip, idle one is pinged"""
+        if self._socket is None or self._responses:
+            return False
+        try:
+            if select.select([self._socket], [], [], 0)[0]:
+                # no response is awaited, so server has closed it
+                return False
+            if (time.time() - self._last_used < self.PING_AFTER or
+                    'ping' not in self.features):
+                return True
+            self._socket.settimeout(self.PING_TIMEOUT)
+            try:
+                meta, _ = self.collect([self.submit({'op': 'PING'})])[0]
+            finally:
+                self._socket.settimeout(self.TIMEOUT)
+            return meta['status'] == self.RESP_OK
+        except Exception:
+            return False
+
+    def query(self, model, queries):
+        """Pipelined CHECKFILE and GETCGO requests.
+        Structure is sent only if server does not have it"""
+        fh = get_pdb_file(model)
+        fh.seek(0)
+        pdb = fh.read()
+        fh.close()
+        checksum = hashlib.sha256(pdb).hexdigest()
+
+        # Compress transfers to remote servers
+        encoding = None
+        if self.address[0] not in self.LOCAL_HOSTS and 'zlib' in self.features:
+            encoding = 'zlib'
+
+        if 'batch' in self.features and len(queries) > 1:
+            # All queries in one request, drawings are named by query index
+            get_cgo = [{'op': 'BATCH', 'name': checksum, 'queries': queries,
+                        'encoding': encoding}]
+            if 'binary-cgo' in self.features:
+                get_cgo[0]['cgo'] = 'binary'
+        else:
+            get_cgo = [dict(query, op='GETCGO', name=checksum) for query in queries]
+            if 'inline-cgo' in self.features:
+                # Drawing is sent back over the socket, so the server
+                # does not have to share filesystem with PyMOL.
+                # Packed CGO array is loaded without running a script
+                cgo = 'binary' if 'binary-cgo' in self.features else 'inline'
+                for request in get_cgo:
+                    request.update(cgo=cgo, encoding=encoding)
+
+        ids = [self.submit({'op': 'CHECKFILE', 'name': model, 'checksum': checksum})]
+        ids += [self.submit(request) for request in get_cgo]
+        responses = self.collect(ids)
+
+        if responses[0][0]['status'] != self.RESP_OK:
+            ids = [self.submit_upload(model, pdb, checksum, encoding)]
+            ids += [self.submit(request) for request in get_cgo]
+            responses = self.collect(ids)
+            if responses[0][0]['status'] != self.RESP_OK:
+                raise Exception('Server refuse to accept file')
+
+        if get_cgo[0]['op'] == 'BATCH':
+            responses = responses[:1] + self.split_batch(*responses[1])
+
+        results = list()
+        for meta, payload in responses[1:]:
+            if meta['status'] != self.RESP_OK:
+                raise Exception("Something went wrong...")
+            if meta.get('encoding') == 'zlib':
+                payload = zlib.decompress(payload)
+            if 'path' not in meta:
+                meta['cgo'] = payload
+            results.append(meta)
+        return results
+
+    def split_batch(self, meta, payload):
+        """Splits BATCH response into (meta, payload) of every query"""
+        if meta['status'] != self.RESP_OK:
+            raise Exception("Something went wrong...")
+        responses = list()
+        payload = memoryview(payload)
+        offset = 0
+        for result in meta['results']:
+            result['encoding'] = meta['encoding']
+            responses.append((result, payload[offset:offset + result['size']]))
+            offset += result['size']
+        return responses
+
+    def submit_upload(self, model, pdb, checksum, encoding):
+        """Sends structure, returns id of the request storing it.
+        Large structures are sent in chunks, only those the server
+        does not have yet go over the wire"""
+        if 'chunks' not in self.features or len(pdb) < self.CHUNKED_UPLOAD_MIN:
+            send_file = {'op': 'SENDFILE', 'name': model}
+            if encoding and 'compressed-upload' in self.features:
+                send_file['encoding'] = encoding
+                pdb = zlib.compress(pdb)
+            return self.submit(send_file, pdb)
+
+        chunks = chunk_content(pdb)
+        digests = b''.join(hashlib.sha256(chunk).digest() for chunk in chunks)
+        meta, _ = self.collect([self.submit(
+            {'op': 'CHUNKS', 'name': model, 'checksum': checksum}, digests)])[0]
+        if meta['status'] != self.RESP_OK:
+            raise Exception('Server refuse to accept file')
+
+        missing = [chunks[i] for i in meta['missing']]
+        logging.debug("Sending {} of {} chunks".format(len(missing), len(chunks)))
+        put_chunks = {'op': 'PUTCHUNKS', 'name': model, 'checksum': checksum,
+                      'sizes': [len(chunk) for chunk in missing]}
+        payload = b''.join(missing)
+        if encoding:
+            put_chunks['encoding'] = encoding
+            payload = zlib.compress(payload)
+        return self.submit(put_chunks, payload)
+
     def close(self):
         """Close the TCP connection"""
-        # Report server that connection is closed
-        self._socket.sendall(''.encode())
-        self._socket.close()
+        if self._socket is None:
+            return
+        try:
+            # Report server that connection is closed
+            self._socket.sendall(''.encode())
+            self._socket.close()
+        except socket.error:
+            pass
+        self._socket = None
 
     def check_file(self, model):
         fh = get_pdb_file(model)
@@ -292,6 +528,9 @@ class TCPClient:
         # Wait for responce
         srv_resp = self._socket.recv(self._bufferSize).decode()
 
+        if srv_resp == self.RESP_BUSY:
+            raise ServerBusyErr()
+
         return True if srv_resp == self.RESP_OK else False
 
     def send_file(self, model):
@@ -325,6 +564,7 @@ class TCPClient:
     def get_cgo(self, model, query):
         """get_CGO draw data"""
         file_name = model.lower()
+        query = json.dumps(query)
         query_len = len(query)
 
         # Send GETCGO request
@@ -376,11 +616,7 @@ class TCPClient:
 
 
 
-        data = json.loads(data)
-
-        summary(data['summary'])
-
-        return data['path']
+        return json.loads(data)
 
 
 def params_parser(solvent, color, invert, opacity):
@@ -411,6 +647,62 @@ def params_parser(solvent, color, invert, opacity):
 
 # --- START OF PYMOL DEPENDENCIES --- 
 
+def get_client(host, port):
+    '''Returns (client, reused). Connection to host and port kept in
+        pymol.stored is reused if it passes health check, otherwise a new
+        one is made and kept if server speaks framed protocol
+    '''
+    key = (host, str(port))
+    client = stored._vcontacts_clients.pop(key, None)
+    if client is not None:
+        if client.alive():
+            stored._vcontacts_clients[key] = client
+            return client, True
+        logging.debug("Kept connection to {}:{} is closed, reconnecting".format(host, port))
+        client.close()
+
+    client = TCPClient(host, port)
+    client.start()
+    # old servers serve one session per connection
+    if client.version >= 2:
+        stored._vcontacts_clients[key] = client
+    return client, False
+
+
+def forget_client(host, port):
+    '''Closes connection kept for host and port'''
+    client = stored._vcontacts_clients.pop((host, str(port)), None)
+    if client is not None:
+        client.close()
+
+
+def query_server(client, reused, host, port, model, query):
+    '''Runs query on kept connection. If the reused connection turns
+        out to be broken, query is sent again over a new one
+    '''
+    try:
+        return client.query(model, [query])[0]
+    except socket.timeout:
+        forget_client(host, port)
+        raise
+    except (socket.error, ConnectionLostErr) as e:
+        forget_client(host, port)
+        if not reused:
+            raise
+        logging.debug("Kept connection is broken: {}, reconnecting".format(e))
+    except Exception:
+        # responses of the connection may be out of step now
+        forget_client(host, port)
+        raise
+
+    client, _ = get_client(host, port)
+    try:
+        return client.query(model, [query])[0]
+    except Exception:
+        forget_client(host, port)
+        raise
+
+
 def get_pdb_file(model):
     '''Returns temp file_obj handler'''
     tmp_file = tempfile.TemporaryFile()
@@ -448,6 +740,59 @@ def draw_CGO(cgo_path):
         logging.info("No contacts found for the given query")
 
 
+def load_CGO(data):
+    '''Draws CGO received from server, packed float32 array or drawing script'''
+    cgo = data['cgo']
+    if not cgo:
+        logging.info("No contacts found for the given query")
+        return
+    if data.get('format') != 'float32':
+        try:
+            name, values = parse_CGO(bytes(cgo).decode())
+        except ValueError as e:
+            logging.error("Invalid drawing received: {}".format(e))
+            return
+        cmd.load_cgo(values, name)
+        cmd.set('two_sided_lighting', 'on')
+        return
+
+    values = array('f')
+    values.frombytes(cgo)
+    if sys.byteorder != 'little':
+        values.byteswap()
+    # load_cgo takes a list of floats
+    cmd.load_cgo(values.tolist(), data['name'])
+    cmd.set('two_sided_lighting', 'on')
+
+
+def parse_CGO(script):
+    '''Returns (name, values) of CGO list in drawing script of draw-contacts.
+        The script is not run, its list may only hold numbers and
+        pymol.cgo constants, ValueError is raised otherwise
+    '''
+    start = script.find('[')
+    end = script.rfind(']')
+    if start < 0 or end < start:
+        raise ValueError("no CGO list in drawing")
+    name = script[script.rfind('\n', 0, start) + 1:start].partition('=')[0].strip()
+    if not re.match(r'^\w+$', name):
+        raise ValueError("bad drawing name {!r}".format(name))
+
+    values = list()
+    for token in script[start + 1:end].split(','):
+        token = token.strip()
+        if not token:
+            continue
+        if re.match(r'^[A-Z_]+$', token):
+            value = getattr(cgo, token, None)
+            if not isinstance(value, (int, float)):
+                raise ValueError("unknown CGO constant {}".format(token))
+            values.append(float(value))
+        else:
+            values.append(float(token))
+    return name, values
+
+
 def summary(data):
     total = 0
     for chain in data:
@@ -498,6 +843,31 @@ def get_serials(selector):
 
 # --- START OF UTILS ---
 
+# Content defined chunking of uploads
+CHUNK_MIN_SIZE = 2 * 1024
+CHUNK_MAX_SIZE = 64 * 1024
+CHUNK_BOUNDARY_MASK = 0x3f
+
+def chunk_content(data):
+    '''Splits PDB content into chunks ending at lines picked by their
+        own content, so an edit only changes chunks around it
+    '''
+    chunks = list()
+    start, end = 0, 0
+
+    for line in data.splitlines(True):
+        end += len(line)
+        size = end - start
+        if size >= CHUNK_MAX_SIZE or (size >= CHUNK_MIN_SIZE and
+                zlib.crc32(line) & CHUNK_BOUNDARY_MASK == 0):
+            chunks.append(data[start:end])
+            start = end
+
+    if start < len(data):
+        chunks.append(data[start:])
+
+    return chunks
+
 def compress_atoms(atoms_list):
     '''Returns compressed atoms list
         [1,2,3,4,6,7,90,101,102,103] => ['1:4', '6:7', '90', '101:103']
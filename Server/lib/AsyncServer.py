@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import socket
+import asyncio
+import logging
+import json
+
+from concurrent.futures import ThreadPoolExecutor
+
+from . import Workspace
+from . import Voronota
+from . import Operations
+from . import Protocol
+from . import Metrics
+from . import Tracing
+
+
+# bytes of an upload read before they are written on the executor
+WRITE_SIZE = 1024 * 1024
+
+
+def write_slabs(upload, stream, slabs):
+    """Writes received slabs to upload, decompressing them with stream"""
+    for slab in slabs:
+        upload.write(stream.decompress(slab) if stream else slab)
+
+
+def finish_upload(upload, stream, slabs, file_name):
+    """Writes the last slabs, stores upload as file_name and starts its
+    contacts calculation. Returns digest of the structure"""
+    write_slabs(upload, stream, slabs)
+    if stream and hasattr(stream, 'flush'):
+        upload.write(stream.flush())
+    if stream and not stream.eof:
+        raise Protocol.ProtocolError("Compressed stream is incomplete")
+    digest = upload.commit(file_name)
+    Voronota.precompute_contacts(digest)
+    return digest
+
+
+class AsyncServer:
+    """Single threaded server speaking the same protocol as TCPServer.
+    Idle connections only cost a coroutine, blocking operations run on
+    a separate executor. Voronota pipelines are limited to jobs at once
+    by the scheduler, the rest wait there ordered by cost"""
+    def __init__(self, host, port, jobs=4, backlog=10, idle_timeout=0):
+        try:
+            self.address = (host, int(port))
+        except ValueError:
+            raise ValueError("Port number must be numeric")
+        self._acpt_conn_num = backlog
+        self._idle_timeout = idle_timeout
+        jobs = jobs or os.cpu_count() or 1
+        # room for jobs queued in the scheduler and for cache hits
+        self._executor = ThreadPoolExecutor(max_workers=jobs * 4)
+
+    def serve_forever(self):
+        """Runs event loop until interrupted"""
+        try:
+            asyncio.run(self._serve())
+        finally:
+            self._executor.shutdown(wait=False)
+            logging.info("Server Shutdown")
+
+    async def _serve(self):
+        server = await asyncio.start_server(
+            self._accept_connection, *self.address,
+            backlog=self._acpt_conn_num)
+        logging.info("Socket created, binded and now listening")
+        async with server:
+            await server.serve_forever()
+
+    async def _accept_connection(self, reader, writer):
+        client_addr = writer.get_extra_info('peername')[:2]
+        logging.info("Connected with: {}:{}".format(*client_addr))
+        # clients keep connections open between queries
+        writer.get_extra_info('socket').setsockopt(
+            socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        handler = AsyncClientHandler(reader, writer, client_addr,
+                                     self._executor, self._idle_timeout)
+        await handler.clientHandler()
+
+
+class AsyncClientHandler:
+    def __init__(self, reader, writer, addr, executor, idle_timeout=0):
+        self.reader = reader
+        self.writer = writer
+        (self.host, self.port) = addr
+        self._executor = executor
+        # seconds to wait for the next framed request, 0 - no limit
+        self._idle_timeout = idle_timeout
+        self._bufferSize = 8192
+        # model name -> digest of structures checked or sent by this client
+        self.aliases = dict()
+        # checksum -> chunk digests of structure being uploaded in chunks
+        self.manifests = dict()
+        self.trace_id = Tracing.new_trace_id()
+        logging.info("Client {}:{} trace {}".format(
+            self.host, self.port, self.trace_id))
+
+    async def send(self, request, encode=True):
+        self.writer.write(request.encode() if encode else request)
+        await self.writer.drain()
+
+    async def recieve(self, decode=True):
+        data = await self.reader.read(self._bufferSize)
+        return data.decode() if decode else data
+
+    async def run_job(self, function, *args):
+        """Runs blocking function on the executor"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, function, *args)
+
+    def resolve(self, file_name):
+        """Returns digest of the structure this client refers to as file_name"""
+        return Workspace.resolve(file_name.lower(), self.aliases)
+
+    async def clientHandler(self):
+        """Coroutine for handling client connection."""
+        Metrics.connection_opened()
+        try:
+            while True:
+                request = await self.recieve()
+                logging.debug(
+                    "Client: {}:{} request: {}"
+                        .format(self.host, self.port, request))
+
+                request = request.split(' ')
+                optCode = request[0]
+
+                if optCode == 'CHECKFILE':
+                    await self.handle_file_check(request[1:])
+                elif optCode == 'SENDFILE':
+                    await self.handle_send_file(request[1:])
+                elif optCode == 'GETCGO':
+                    await self.handle_get(request[1:])
+                elif optCode == 'HELLO':
+                    await self.handle_hello(request[1:])
+                    break
+                elif optCode == 'PING':
+                    await self.send("OK")
+                elif optCode == '':
+                    # client closed the connection
+                    break
+                else:
+                    # connection is kept, client may go on
+                    await self.send("BADREQUEST")
+                    logging.debug("Server: Response send to {}:{} response: BADREQUEST"
+                        .format(self.host, self.port))
+        except Exception as e:
+            logging.critical(e)
+
+        # Close client connection
+        self.writer.close()
+        Metrics.connection_closed()
+        logging.info("Server: Conection with {}:{} is closed"
+            .format(self.host, self.port))
+
+    async def handle_hello(self, request):
+        """Switches connection to framed protocol"""
+        resp = Protocol.hello_response()
+        await self.send(resp)
+        logging.debug("Server: Response send to {}:{} response: {}".format(
+            self.host, self.port, resp))
+        await self.framedHandler()
+
+    async def framedHandler(self):
+        """Handles framed requests until client closes the connection or
+        stays idle for longer than idle timeout.
+        Requests are processed in the order they arrive"""
+        while True:
+            try:
+                header = await asyncio.wait_for(
+                    self.reader.readexactly(Protocol.HEADER.size),
+                    self._idle_timeout or None)
+            except asyncio.IncompleteReadError as e:
+                if e.partial:
+                    raise
+                break
+            except asyncio.TimeoutError:
+                logging.debug("Client: {}:{} is idle, closing".format(
+                    self.host, self.port))
+                break
+            with Tracing.span('receive', trace_id=self.trace_id):
+                meta_size, payload_size = Protocol.unpack_header(header)
+                meta = Protocol.unpack_meta(
+                    await self.reader.readexactly(meta_size))
+                payload = await self.reader.readexactly(payload_size)
+            logging.debug("Client: {}:{} framed request: {}".format(
+                self.host, self.port, meta))
+
+            resp_meta, resp_payload = await self.run_job(
+                Operations.dispatch, self, meta, payload)
+            with Metrics.timed('transfer'), \
+                    Tracing.span('send', trace_id=self.trace_id):
+                self.writer.write(
+                    Protocol.pack_header(resp_meta, len(resp_payload)))
+                if resp_payload:
+                    self.writer.write(resp_payload)
+                await self.writer.drain()
+
+    async def handle_file_check(self, request):
+        """Server FILE. Check if servas has file"""
+        file_name     = request[0].lower()
+        file_checksum = request[1]
+
+        logging.debug("Client: {}:{} requested a CHECKFILE: {} {}".format(
+            self.host, self.port, file_name, file_checksum))
+
+        if await self.run_job(Workspace.file_check_checksum, file_checksum):
+            self.aliases[file_name] = file_checksum
+            await self.run_job(Workspace.set_alias, file_name, file_checksum)
+            resp = "OK"
+        else:
+            resp = "NOTFOUND"
+        await self.send(resp)
+        logging.debug("Server: Response send to {}:{} response: {}"
+            .format(self.host, self.port, resp))
+
+    async def handle_send_file(self, request):
+        """Server PUT. Handles file transfering from client"""
+        file_name = request[0].lower()
+        file_size = request[1]
+        # compressed upload, file_size is size of compressed data
+        encoding = request[2] if len(request) > 2 else None
+        logging.debug("Client:  {}:{} requested a SENDFILE for: {} {} {}".format(
+            self.host, self.port, file_name, file_size, encoding))
+
+        # Send back OK as ACK
+        await self.send("OK")
+
+        started = time.time()
+        with Tracing.span('receive', trace_id=self.trace_id):
+            upload = await self.run_job(Workspace.Upload)
+            try:
+                stream = Protocol.decompressor(encoding) if encoding else None
+                # slabs are read here, hashed and written on the executor
+                slabs, buffered = list(), 0
+                bytes_remaining = int(file_size)
+                while bytes_remaining != 0:
+                    slab = await self.reader.read(
+                        min(bytes_remaining, self._bufferSize))
+                    if not slab:
+                        raise IOError("Connection closed while receiving {}"
+                            .format(file_name))
+                    slabs.append(slab)
+                    buffered += len(slab)
+                    bytes_remaining -= len(slab)
+                    if buffered >= WRITE_SIZE:
+                        await self.run_job(write_slabs, upload, stream, slabs)
+                        slabs, buffered = list(), 0
+                digest = await self.run_job(
+                    finish_upload, upload, stream, slabs, file_name)
+            except Exception:
+                upload.abort()
+                raise
+        Metrics.observe('upload', time.time() - started)
+        self.aliases[file_name] = digest
+        logging.debug("Server: File {} from {}:{} stored as {}".format(
+            file_name, self.host, self.port, digest))
+
+        await self.send("OK")
+        logging.debug("Response send to {}:{} response: OK".format(
+            self.host, self.port))
+
+    async def handle_get(self, request):
+        """Coroutine for handling client GET"""
+        file_name = await self.run_job(self.resolve, request[0])
+
+        if file_name is None:
+            await self.send("NOTFOUND")
+            logging.debug("Server: Response send to {}:{} response: NOTFOUND"
+                .format(self.host, self.port))
+            return
+        await self.send("OK")
+
+        # Recieve query len
+        querylen = await self.recieve()
+        logging.debug("Server: Query recieved len from {}:{} query len: {}"
+            .format(self.host, self.port, querylen))
+
+        # Send OK as ACK
+        await self.send("OK")
+
+        # Recieve query
+        query = await self.reader.readexactly(int(querylen))
+        query = query.decode()
+        logging.debug("Client: Query received from {}:{} query: {}".format(
+            self.host, self.port, query))
+
+        query_dict = json.loads(query)
+        data = await self.run_job(Operations.legacy_get,
+            self, file_name, query_dict['filter'], query_dict['params'])
+
+        if data is None:
+            await self.send("SERVERERROR")
+            return
+
+        data = json.dumps(data)
+
+        resp = "OK " + str(len(data))
+        await self.send(resp)
+        logging.debug("Server: Response send to {}:{} (SIZE) response: {}".format(
+            self.host, self.port, resp))
+
+        ack = await self.recieve()
+        logging.debug("Client: ACK recieved from {}:{} ACK: {}".format(
+            self.host, self.port, ack))
+
+        with Metrics.timed('transfer'), \
+                Tracing.span('send', trace_id=self.trace_id):
+            await self.send(data)
+
+        logging.debug("Server: File has been sent to {}:{}".format(
+            self.host, self.port))
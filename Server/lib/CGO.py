@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""Drawings of draw-contacts as packed CGO arrays.
+
+draw-contacts --drawing-for-pymol writes a Python script holding one
+CGO list. Clients supporting it get the list as little endian float32
+values instead, loaded with cmd.load_cgo without PyMOL parsing and
+running megabytes of Python source."""
+
+import sys
+from array import array
+
+# Values of pymol.cgo constants used by draw-contacts, drawings holding
+# others are sent as scripts
+CONSTANTS = {
+    'BEGIN': 2, 'END': 3, 'VERTEX': 4, 'NORMAL': 5, 'COLOR': 6, 'ALPHA': 25,
+    'TRIANGLE_STRIP': 5, 'TRIANGLE_FAN': 6,
+}
+
+# longest first, so no constant is replaced inside another
+_replacements = [(name.encode(), str(value).encode())
+                 for name, value in sorted(CONSTANTS.items(), key=lambda c: -len(c[0]))]
+
+
+def pack(script):
+    """Returns (name, values) of CGO list in drawing script, values are
+    packed little endian float32. Empty script gives (None, b'').
+    Raises ValueError if script holds anything else than numbers and
+    CONSTANTS"""
+    if not script:
+        return None, b''
+    start = script.find(b'[')
+    end = script.rfind(b']')
+    if start < 0 or end < start:
+        raise ValueError("No CGO list in drawing")
+    name = script[script.rfind(b'\n', 0, start) + 1:start].partition(b'=')[0].strip()
+
+    body = script[start + 1:end]
+    for constant, value in _replacements:
+        body = body.replace(constant, value)
+    tokens = body.split(b',')
+    if tokens and not tokens[-1].strip():
+        tokens.pop()
+
+    values = array('f', map(float, tokens))
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return name.decode(), values.tobytes()
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 
+import errno
 import logging
+import socket
 import sys
 import json
 python3 = sys.version_info >= (3,0)
@@ -8,16 +10,38 @@ python3 = sys.version_info >= (3,0)
 if python3:
     from . import Workspace
     from . import Voronota
+    from . import Operations
+    from . import Protocol
+    from . import Metrics
+    from . import Tracing
 else:
     import Workspace
     import Voronota
+    import Operations
+    import Protocol
+    import Metrics
+    import Tracing
 
 class ClientHandler:
-    def __init__(self, conn, addr):
+    """Serves one client connection. With park given, a framed
+    connection waiting for its next request is handed to park(handler)
+    instead of holding the thread, resume() serves it once it is readable"""
+    def __init__(self, conn, addr, idle_timeout=0, park=None):
         self.conn = conn
         (self.host, self.port) = addr
         self._bufferSize = 8192
-        self.clientHandler()
+        # seconds to wait for the next framed request, 0 - no limit
+        self._idle_timeout = idle_timeout
+        self._park = park
+        # model name -> digest of structures checked or sent by this client
+        self.aliases = dict()
+        # checksum -> chunk digests of structure being uploaded in chunks
+        self.manifests = dict()
+        self.trace_id = Tracing.new_trace_id()
+        logging.info("Client {}:{} trace {}".format(
+            self.host, self.port, self.trace_id))
+        with Tracing.trace(self.trace_id):
+            self.clientHandler()
 
     def __del__(self):
         pass
@@ -33,8 +57,47 @@ class ClientHandler:
             return self.conn.recv(self._bufferSize).decode()
         return self.conn.recv(self._bufferSize)
 
+    def recieve_exactly(self, size):
+        """Receives exactly size bytes, returns None if connection was
+        closed before any byte was received"""
+        data = bytearray()
+        while len(data) < size:
+            slab = self.conn.recv(min(size - len(data), self._bufferSize))
+            if not slab:
+                if not data:
+                    return None
+                raise IOError("Connection closed in the middle of a frame")
+            data += slab
+        return bytes(data)
+
+    def has_pending(self):
+        """Checks without blocking if client sent more data or closed the
+        connection. select() is not used, it fails on descriptors over
+        FD_SETSIZE which many kept connections reach"""
+        self.conn.settimeout(0)
+        try:
+            self.conn.recv(1, socket.MSG_PEEK)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return False
+            raise
+        return True
+
+    def recieve_frame_part(self, size):
+        """Receives exactly size bytes following a frame header, raises
+        IOError if connection was closed before them"""
+        data = self.recieve_exactly(size)
+        if data is None:
+            raise IOError("Connection closed in the middle of a frame")
+        return data
+
+    def resolve(self, file_name):
+        """Returns digest of the structure this client refers to as file_name"""
+        return Workspace.resolve(file_name.lower(), self.aliases)
+
     def clientHandler(self):
         """Function for handling client connection."""
+        Metrics.connection_opened()
         try:
             while True:
                 request = self.recieve()
@@ -49,27 +112,92 @@ class ClientHandler:
                     # request = "opt-code, file-name, checksum"
                     self.handle_file_check(request[1:])
                 elif optCode == 'SENDFILE':
-                    # request = "opt-code, file-name"
+                    # request = "opt-code, file-name, size[, encoding]"
                     self.handle_send_file(request[1:])
                 elif optCode == 'GETCGO':
                     # reqest = "opt-code, program, file, *args"
                     self.handle_get(request[1:])
-                else:
+                elif optCode == 'HELLO':
+                    # request = "opt-code, protocol-version"
+                    if self.handle_hello(request[1:]):
+                        # connection waits for the next request parked
+                        return
                     break
-                # else:
-                #     resp = "BADREQUEST"
-                #     self.conn.sendall(resp.encode())
-                #     logging.debug("Server: Response send to {}:{} response: {}"
-                #         .format(self.host, self.port, resp))
-                #     break
+                elif optCode == 'PING':
+                    self.send("OK")
+                elif optCode == '':
+                    # client closed the connection
+                    break
+                else:
+                    # connection is kept, client may go on
+                    resp = "BADREQUEST"
+                    self.send(resp)
+                    logging.debug("Server: Response send to {}:{} response: {}"
+                        .format(self.host, self.port, resp))
         except Exception as e:
             logging.critical(e)
 
-        # Close client connection
+        self.close()
+
+    def close(self):
+        """Closes client connection"""
         self.conn.close()
+        Metrics.connection_closed()
         logging.info("Server: Conection with {}:{} is closed"
             .format(self.host, self.port))
 
+    def resume(self):
+        """Serves requests of parked connection which became readable"""
+        with Tracing.trace(self.trace_id):
+            try:
+                if self.framedHandler():
+                    return
+            except Exception as e:
+                logging.critical(e)
+            self.close()
+
+    def handle_hello(self, request):
+        """Switches connection to framed protocol.
+        Returns True if the connection was parked"""
+        resp = Protocol.hello_response()
+        self.send(resp)
+        logging.debug("Server: Response send to {}:{} response: {}".format(
+            self.host, self.port, resp))
+        return self.framedHandler()
+
+    def framedHandler(self):
+        """Handles framed requests until client closes the connection or
+        stays idle for longer than idle timeout.
+        Requests are processed in the order they arrive. Returns True if
+        the connection was parked waiting for the next request"""
+        while True:
+            if self._park is not None and not self.has_pending():
+                # nothing pipelined, thread is not held while client is idle
+                self._park(self)
+                return True
+            self.conn.settimeout(self._idle_timeout or None)
+            try:
+                header = self.recieve_exactly(Protocol.HEADER.size)
+            except socket.timeout:
+                logging.debug("Client: {}:{} is idle, closing".format(
+                    self.host, self.port))
+                break
+            if header is None:
+                break
+            with Tracing.span('receive'):
+                meta_size, payload_size = Protocol.unpack_header(header)
+                meta = Protocol.unpack_meta(self.recieve_frame_part(meta_size))
+                payload = self.recieve_frame_part(payload_size)
+            logging.debug("Client: {}:{} framed request: {}".format(
+                self.host, self.port, meta))
+
+            resp_meta, resp_payload = Operations.dispatch(self, meta, payload)
+            with Metrics.timed('transfer'), Tracing.span('send'):
+                self.send(Protocol.pack_header(resp_meta, len(resp_payload)),
+                    encode=False)
+                if resp_payload:
+                    self.send(resp_payload, encode=False)
+
     def handle_file_check(self, request):
         """Server FILE. Check if servas has file"""
         file_name     = request[0].lower()
@@ -79,7 +207,9 @@ class ClientHandler:
             self.host, self.port, file_name, file_checksum))
 
         # check if file exist in server dir
-        if Workspace.file_check_checksum(file_name, file_checksum):
+        if Workspace.file_check_checksum(file_checksum):
+            self.aliases[file_name] = file_checksum
+            Workspace.set_alias(file_name, file_checksum)
             self.send("OK")
             logging.debug("Server: Response send to {}:{} response: OK"
             .format(self.host,self.port))
@@ -92,8 +222,10 @@ class ClientHandler:
         """Server PUT. Handles file transfering from client"""
         file_name = request[0].lower()
         file_size = request[1]
-        logging.debug("Client:  {}:{} requested a SENDFILE for: {} {}".format(
-            self.port, self.host, file_name, file_size))
+        # compressed upload, file_size is size of compressed data
+        encoding = request[2] if len(request) > 2 else None
+        logging.debug("Client:  {}:{} requested a SENDFILE for: {} {} {}".format(
+            self.port, self.host, file_name, file_size, encoding))
 
         # Send back OK as ACK
         resp = "OK"
@@ -102,45 +234,41 @@ class ClientHandler:
             self.host, self.port, resp))
 
         # Receive file
+        with Metrics.timed('upload'), Tracing.span('receive'):
+            digest = Workspace.store_file(Protocol.decompress_stream(
+                self.recieve_slabs(int(file_size), file_name), encoding), file_name)
+        self.aliases[file_name] = digest
+        Voronota.precompute_contacts(digest)
+        logging.debug("Server: File {} from {}:{} stored as {}".format(
+            file_name, self.host, self.port, digest))
 
-        # create file path
-        path = Workspace.mkdir(file_name)
-        filePath = Workspace.construct_file_path(path, file_name)
-
-        # send file in slices of self._bufferSize bytes:
-        # open file in read byte mode:
-        fh = open(filePath, "wb") # write bytes flag is passed
-
-        bytes_remaining = int(file_size)
-
-        while bytes_remaining != 0:
-            if(bytes_remaining >= self._bufferSize):
-                # receive slab from client
-                slab = self.conn.recv(self._bufferSize)
-                fh.write(slab)
-                sizeof_slab_received = len(slab)
-                logging.debug("Server: From {}:{} Bytes received: {} File: {}"
-                    .format(self.host, self.port, sizeof_slab_received, file_name))
-                bytes_remaining -= int(sizeof_slab_received)
-            else:
-                #receive slab from server
-                slab = self.conn.recv(bytes_remaining)
-                fh.write(slab)
-                sizeof_slab_received = len(slab)
-                logging.debug("Server: From {}:{} Bytes received: {} File: {}".format(
-                    self.host, self.port, sizeof_slab_received, file_name))
-                bytes_remaining -= int(sizeof_slab_received)
-        fh.close()
         resp = "OK"
         self.conn.sendall(resp.encode())
         logging.debug("Response send to {}:{} response: {}".format(
             self.host, self.port, resp))
 
+    def recieve_slabs(self, file_size, file_name):
+        """Yields file content received from client in slices of
+        self._bufferSize bytes"""
+        bytes_remaining = file_size
+
+        while bytes_remaining != 0:
+            # receive slab from client
+            slab = self.conn.recv(min(bytes_remaining, self._bufferSize))
+            if not slab:
+                raise IOError("Connection closed while receiving {}"
+                    .format(file_name))
+            sizeof_slab_received = len(slab)
+            logging.debug("Server: From {}:{} Bytes received: {} File: {}"
+                .format(self.host, self.port, sizeof_slab_received, file_name))
+            bytes_remaining -= sizeof_slab_received
+            yield slab
+
     def handle_get(self, request):
         """Function for handling client GET"""
-        file_name = request[0]
+        file_name = self.resolve(request[0])
 
-        if Workspace.file_exists(file_name):
+        if file_name is not None:
             # EXISTS
             resp = "OK" # OK
             self.conn.sendall(resp.encode())
@@ -192,43 +320,18 @@ class ClientHandler:
         logging.debug("Client: Query received from {}:{} query: {}".format(
             self.host, self.port, query))
 
-        success = Voronota.create_contacts_file(file_name)
-
-        if not success:
-            resp = "SERVERERROR" # Internal server error
-            self.conn.sendall(resp.encode())
-            logging.debug("Server: Response send to {}:{} response: {}".format(
-                self.host, self.port, resp))
-
-
         query_dict = json.loads(query)
-        query = query_dict['filter']
-        params = query_dict['params']
-
-        success = Voronota.draw(file_name, query, self.port, params)
+        data = Operations.legacy_get(
+            self, file_name, query_dict['filter'], query_dict['params'])
 
-        # if ClientErr:
-        #     resp = "BADQUERY" # Bad request
-        #     self.conn.sendall(resp.encode())
-        #     logging.debug("Response send to {}:{} response: {}".format(
-        #         self.host, self.port, resp))
-
-        if not success:
+        if data is None:
             resp = "SERVERERROR" # Internal server error
             self.conn.sendall(resp.encode())
             logging.debug("Server: Response send to {}:{} response: {}".format(
                 self.host, self.port, resp))
+            return
 
-        draw_file = Workspace.construct_file_path(
-            Workspace.mkdir(file_name), 'draw' + str(self.port))
-
-        # size = Workspace.get_file_size(draw_file)
-        summary = Voronota.summarize(file_name, query)
-
-        data = json.dumps({
-            'path': draw_file,
-            'summary': summary
-        })
+        data = json.dumps(data)
 
         resp = "OK " + str(len(data))
         self.conn.sendall(resp.encode())
@@ -239,7 +342,8 @@ class ClientHandler:
         logging.debug("Client: ACK recieved from {}:{} ACK: {}".format(
             self.host, self.port, ack))
 
-        self.conn.sendall(data.encode())
+        with Metrics.timed('transfer'), Tracing.span('send'):
+            self.conn.sendall(data.encode())
 
         logging.debug("Server: File has been sent to {}:{}".format(
             self.host, self.port))
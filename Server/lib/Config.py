@@ -14,6 +14,12 @@ else:
 HOST = '127.0.0.1'
 PORT = 8888
 SERVER_DIR = 'serverWorkSpace'
+ENGINE = 'threads'
+WORKERS = 8
+QUEUE_SIZE = 32
+LISTEN_BACKLOG = 10
+IDLE_TIMEOUT = 600
+METRICS_PORT = 0
 
 # Logger
 LOGGER_FILE = 'server.log'
@@ -22,9 +28,18 @@ LOGGER_FORMATTER = "%(asctime)s:%(levelname)s:%(message)s"
 #
 CHECK_FOR_OLD_FILES = 86400
 OLDER_THAN = 86400
+DISK_QUOTA = 0
+
+# Query result cache, sizes in bytes
+RESULT_CACHE_MEMORY = 64 * 1024 * 1024
+RESULT_CACHE_DISK = 512 * 1024 * 1024
 
 # Program
 PROGRAM_PATH = 'voronota'
+MAX_JOBS = 0
+QUERY_ENGINE = 'native'
+INDEX_SIZE = 16
+PRECOMPUTE = True
 # program params
 COMMAND_ATOMS = 'get-balls-from-atoms-file'
 COMMAND_CONTACTS = 'calculate-contacts'
@@ -49,6 +64,12 @@ config.read(os.path.join(path, 'config.ini'))
 HOST = config.get('Server', 'HOST')
 PORT = config.get('Server', 'PORT')
 SERVER_DIR = os.path.join(path, config.get('Server', 'SERVER_CHACHE_NAME'))
+ENGINE = config.get('Server', 'ENGINE')
+WORKERS = int(config.get('Server', 'WORKERS'))
+QUEUE_SIZE = int(config.get('Server', 'QUEUE_SIZE'))
+LISTEN_BACKLOG = int(config.get('Server', 'LISTEN_BACKLOG'))
+IDLE_TIMEOUT = int(config.get('Server', 'IDLE_TIMEOUT'))
+METRICS_PORT = int(config.get('Server', 'METRICS_PORT'))
 LOGGER_FILE = os.path.join(path, config.get('Logger', "LOGGER_FILE"))
 
 if python3:
@@ -58,5 +79,13 @@ else:
 
 CHECK_FOR_OLD_FILES = int(config.get('Cleanup', 'RUN_CHECK_EVERY'))
 OLDER_THAN = int(config.get('Cleanup', 'CACHE_LIFETIME'))
+DISK_QUOTA = int(config.get('Cleanup', 'DISK_QUOTA'))
+
+RESULT_CACHE_MEMORY = int(config.get('Cache', 'MEMORY'))
+RESULT_CACHE_DISK = int(config.get('Cache', 'DISK'))
 
 PROGRAM_PATH = config.get('Voronota','PROGRAM_EXE')
+MAX_JOBS = int(config.get('Voronota', 'MAX_JOBS'))
+QUERY_ENGINE = config.get('Voronota', 'QUERY_ENGINE')
+INDEX_SIZE = int(config.get('Voronota', 'INDEX_SIZE'))
+PRECOMPUTE = config.getboolean('Voronota', 'PRECOMPUTE')
@@ -0,0 +1,634 @@
+# -*- coding: utf-8 -*-
+"""In-memory columnar index of contacts files.
+
+Contacts file is parsed once into numpy arrays and query-contacts
+selections produced by the client (--match-first, --match-second, area,
+distance and sequence separation bounds) are evaluated as vectorized
+masks. Only drawing still needs voronota: draw-contacts gets the
+selected lines of the contacts file on its stdin.
+
+Besides area by chain both the index and the streaming Summary of
+voronota output give details: area and number of contacts by chain
+pair, by residue and by atom class (element) of atoms matching the
+first selection."""
+
+import logging
+import mmap
+import os
+import sys
+import threading
+
+from collections import OrderedDict
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+python3 = sys.version_info >= (3,0)
+
+if python3:
+    from .SingleFlight import SingleFlight
+    from .Config import *
+else:
+    from SingleFlight import SingleFlight
+    from Config import *
+
+# voronota's value of a missing residue number or atom serial
+NULL_NUM = -2 ** 31
+SOLVENT = b'c<solvent>'
+
+# descriptor markers: chain, residue number, insertion code, atom serial,
+# alternate location, residue name, atom name
+NUMERIC_MARKERS = ('r', 'a')
+STRING_MARKERS = ('c', 'i', 'l', 'R', 'A')
+
+# voronota output is read in blocks of this size
+BLOCK_SIZE = 1 << 20
+
+# contacts file path -> ContactIndex, least recently used first
+_indexes = OrderedDict()
+_indexes_lock = threading.Lock()
+_index_flight = SingleFlight()
+_counters = {'hits': 0, 'misses': 0}
+
+
+def enabled():
+    """True if queries are answered by the index instead of voronota"""
+    return np is not None and QUERY_ENGINE == 'native'
+
+
+class Query(object):
+    """Parsed query-contacts arguments"""
+    def __init__(self):
+        self.first = None
+        self.first_not = None
+        self.second = None
+        self.second_not = None
+        # voronota defaults, contacts with zero area or distance never match
+        self.min_area = sys.float_info.min
+        self.max_area = sys.float_info.max
+        self.min_dist = sys.float_info.min
+        self.max_dist = sys.float_info.max
+        self.min_seq_sep = None
+        self.max_seq_sep = None
+        self.no_solvent = False
+        self.no_same_chain = False
+        self.invert = False
+
+
+_SELECTIONS = {
+    '--match-first': 'first',
+    '--match-first-not': 'first_not',
+    '--match-second': 'second',
+    '--match-second-not': 'second_not',
+}
+_FLOATS = {
+    '--match-min-area': 'min_area',
+    '--match-max-area': 'max_area',
+    '--match-min-dist': 'min_dist',
+    '--match-max-dist': 'max_dist',
+}
+_INTS = {
+    '--match-min-seq-sep': 'min_seq_sep',
+    '--match-max-seq-sep': 'max_seq_sep',
+}
+_FLAGS = {
+    '--no-solvent': 'no_solvent',
+    '--no-same-chain': 'no_same_chain',
+    '--invert': 'invert',
+}
+
+
+def parse_query(args):
+    """Parses query-contacts arguments.
+    Raises ValueError on arguments the index can't answer, those queries
+    are left to voronota"""
+    query = Query()
+    args = [arg for arg in args if arg]
+    i = 0
+    while i < len(args):
+        option = args[i]
+        if option in _FLAGS:
+            setattr(query, _FLAGS[option], True)
+            i += 1
+            continue
+        if i + 1 >= len(args):
+            raise ValueError("Option {} has no value".format(option))
+        value = _unquote(args[i + 1])
+        if option in _SELECTIONS:
+            setattr(query, _SELECTIONS[option], _parse_selection(value))
+        elif option in _FLOATS:
+            setattr(query, _FLOATS[option], float(value))
+        elif option in _INTS:
+            setattr(query, _INTS[option], int(value))
+        else:
+            raise ValueError("Unsupported option {}".format(option))
+        i += 2
+    return query
+
+
+def _unquote(value):
+    """Strips quotes the same way voronota does for its arguments"""
+    if len(value) > 2 and value[0] == value[-1] and value[0] in '\'"':
+        return value[1:-1]
+    return value
+
+
+def _split_set(values, separator):
+    """Splits selection string the way voronota reads it into a set"""
+    result = set()
+    for line in values.split(separator):
+        tokens = line.split('#')[0].split()
+        if tokens:
+            result.add(tokens[0])
+    return sorted(result)
+
+
+def _parse_selection(values):
+    """Parses selection like 'c<A,B>&r<1:10>|R<GLY>' into list of
+    alternatives, each a list of (marker, terms) which all must match.
+    Empty selection (matches everything) is None"""
+    if not values:
+        return None
+    return [[_parse_value(value) for value in _split_set(alternative, '&')]
+            for alternative in _split_set(values, '|')]
+
+
+def _parse_value(value):
+    """Parses single value like 'c<A,B>' or 'r<1:5,8>' into (marker, terms).
+    Numeric terms are (min, max) intervals"""
+    tokens = value.replace('<', ' ').replace('>', ' ').replace(',', ' ').split()
+    if not tokens or tokens[0] not in NUMERIC_MARKERS + STRING_MARKERS:
+        raise ValueError("Invalid selection string '{}'".format(value))
+
+    marker = tokens[0]
+    terms = list()
+    control = list()
+    for token in tokens[1:]:
+        if marker in NUMERIC_MARKERS:
+            low, sep, high = token.partition(':')
+            low = int(low)
+            high = int(high) if sep else low
+            if low > high:
+                raise ValueError("Invalid selection string '{}'".format(value))
+            terms.append((low, high))
+            control.append('{}:{}'.format(low, high) if sep else str(low))
+        else:
+            terms.append(token)
+            control.append(token)
+
+    # same check as voronota, rejects anything it would not read back
+    if '{}<{}>'.format(marker, ','.join(control)) != value:
+        raise ValueError("Invalid selection string '{}'".format(value))
+    return marker, terms
+
+
+def parse_descriptor(descriptor):
+    """Splits descriptor like 'c<A>r<1>a<1>R<GLY>A<N>' into {marker: value}"""
+    values = dict()
+    for part in descriptor.split('>'):
+        marker, _, value = part.partition('<')
+        if marker:
+            values[marker] = value
+    return values
+
+
+def residue_name(values):
+    """Descriptor of residue of parsed atom descriptor"""
+    return ''.join('{}<{}>'.format(marker, values[marker])
+                   for marker in ('c', 'r', 'i', 'R') if marker in values)
+
+
+def atom_class(values):
+    """Element of parsed atom descriptor guessed from atom name"""
+    for char in values.get('A', ''):
+        if char.isalpha():
+            return char
+    # solvent has no atom name
+    return values.get('c', '')
+
+
+def read_blocks(stream):
+    """Yields lists of whole lines of stream read in blocks"""
+    rest = b''
+    for block in iter(lambda: stream.read(BLOCK_SIZE), b''):
+        lines = (rest + block).split(b'\n')
+        rest = lines.pop()
+        yield lines
+    if rest:
+        yield [rest]
+
+
+class ContactIndex(object):
+    """Columns of one contacts file.
+    Atoms (descriptors) are stored once, contacts refer to them by row"""
+    def __init__(self, contacts_file):
+        self.contacts_file = contacts_file
+
+        descriptors = dict()
+        first, second, area, dist, start, end = [], [], [], [], [], []
+        offset = 0
+        with open(contacts_file, 'rb') as fh:
+            for line in fh:
+                fields = line.split(b' ', 4)
+                if len(fields) >= 4:
+                    first.append(descriptors.setdefault(fields[0], len(descriptors)))
+                    second.append(descriptors.setdefault(fields[1], len(descriptors)))
+                    area.append(float(fields[2]))
+                    dist.append(float(fields[3]))
+                    start.append(offset)
+                    end.append(offset + len(line))
+                offset += len(line)
+
+        self.first = np.array(first, dtype=np.int32)
+        self.second = np.array(second, dtype=np.int32)
+        self.area = np.array(area, dtype=np.float64)
+        self.dist = np.array(dist, dtype=np.float64)
+        self.start = np.array(start, dtype=np.int64)
+        self.end = np.array(end, dtype=np.int64)
+        self._build_atoms(list(descriptors))
+
+    def _build_atoms(self, descriptors):
+        """Splits descriptors into per marker columns.
+        String columns are stored as codes into a sorted vocabulary"""
+        parsed = [parse_descriptor(d.decode()) for d in descriptors]
+
+        self.numbers = dict()
+        for marker in NUMERIC_MARKERS:
+            self.numbers[marker] = np.array(
+                [int(p[marker]) if marker in p else NULL_NUM for p in parsed],
+                dtype=np.int64)
+
+        self.vocabulary = dict()
+        self.codes = dict()
+        for marker in STRING_MARKERS:
+            vocabulary, codes = np.unique(
+                [p.get(marker, '') for p in parsed], return_inverse=True)
+            self.vocabulary[marker] = {v: i for i, v in enumerate(vocabulary.tolist())}
+            self.codes[marker] = codes.reshape(-1).astype(np.int32)
+
+        self.solvent = np.array([d == SOLVENT for d in descriptors], dtype=bool)
+        self.icode_ord = np.array(
+            [ord(p['i'][0]) if p.get('i') else 0 for p in parsed], dtype=np.int64)
+
+        # groups of details
+        self.groups = dict()
+        for group, name in (('residues', residue_name), ('atom_classes', atom_class)):
+            names, codes = np.unique([name(p) for p in parsed], return_inverse=True)
+            self.groups[group] = (names.tolist(), codes.reshape(-1))
+
+    def __len__(self):
+        return len(self.area)
+
+    def _match_value(self, marker, terms):
+        """Atom mask of single selection value"""
+        if marker in NUMERIC_MARKERS:
+            column = self.numbers[marker]
+            mask = np.zeros(len(column), dtype=bool)
+            for low, high in terms:
+                mask |= (column >= low) & (column <= high)
+            return mask
+
+        column = self.codes[marker]
+        vocabulary = self.vocabulary[marker]
+        codes = [vocabulary[t] for t in terms if t in vocabulary]
+        return np.isin(column, codes)
+
+    def _match_selection(self, selection):
+        """Atom mask of parsed selection"""
+        mask = np.zeros(len(self.solvent), dtype=bool)
+        for alternative in selection:
+            all_match = np.ones(len(self.solvent), dtype=bool)
+            for marker, terms in alternative:
+                all_match &= self._match_value(marker, terms)
+            mask |= all_match
+        return mask
+
+    def match_atoms(self, positive, negative):
+        """Atom mask of voronota match_crad"""
+        mask = np.ones(len(self.solvent), dtype=bool)
+        if positive is not None:
+            mask &= self._match_selection(positive)
+        if negative is not None:
+            mask &= ~self._match_selection(negative)
+        return mask
+
+    def _match_seq_sep(self, min_sep, max_sep):
+        """Contact mask of sequence separation interval"""
+        if min_sep is None and max_sep is None:
+            return np.ones(len(self), dtype=bool)
+
+        a, b = self.first, self.second
+        chain = self.codes['c']
+        resnum = self.numbers['r']
+        same_chain = chain[a] == chain[b]
+        checkable = (resnum[a] != NULL_NUM) & (resnum[b] != NULL_NUM) & same_chain
+
+        sep = np.abs(resnum[a] - resnum[b])
+        icode = self.codes['i']
+        differ = (sep == 0) & (icode[a] != icode[b])
+        both = (self.icode_ord[a] != 0) & (self.icode_ord[b] != 0)
+        # voronota compares first insertion code with the end of the second
+        sep = np.where(differ, np.where(both, self.icode_ord[a], 1), sep)
+
+        in_range = np.ones(len(self), dtype=bool)
+        if min_sep is not None:
+            in_range &= sep >= min_sep
+        if max_sep is not None:
+            in_range &= sep <= max_sep
+
+        uncheckable = same_chain if max_sep is not None else True
+        return np.where(checkable, in_range, uncheckable)
+
+    def select(self, query):
+        """Returns indices of contacts selected by query and flags of those
+        which match first and second selections in reverse order"""
+        a, b = self.first, self.second
+
+        passed = ((self.area >= query.min_area) & (self.area <= query.max_area) &
+                  (self.dist >= query.min_dist) & (self.dist <= query.max_dist))
+        if query.no_solvent:
+            passed &= ~(self.solvent[a] | self.solvent[b])
+        if query.no_same_chain:
+            passed &= self.codes['c'][a] != self.codes['c'][b]
+        passed &= self._match_seq_sep(query.min_seq_sep, query.max_seq_sep)
+
+        first = self.match_atoms(query.first, query.first_not)
+        second = self.match_atoms(query.second, query.second_not)
+        direct = first[a] & second[b]
+        reverse = ~direct & first[b] & second[a]
+        passed &= direct | reverse
+
+        if query.invert:
+            passed = ~passed
+            reverse = np.zeros(len(self), dtype=bool)
+
+        return np.flatnonzero(passed), reverse[passed]
+
+    def summarize(self, query, selected=None):
+        """Returns (summary, details) of selected contacts. Summary is
+        contact area by chain of atoms matching first selection, same as
+        query-contacts --summarize-by-first summed by chain.
+        selected is result of select(query) if it is already known"""
+        index, reverse = selected if selected is not None else self.select(query)
+        first = self.match_atoms(query.first, query.first_not)
+        names = sorted(self.vocabulary['c'], key=self.vocabulary['c'].get)
+
+        atoms = np.concatenate((self.first[index], self.second[index]))
+        area = np.concatenate((self.area[index], self.area[index]))
+        keep = first[atoms]
+        atoms, area = atoms[keep], area[keep]
+        atom_area = np.bincount(atoms, weights=area, minlength=len(self.solvent))
+        matched = np.unique(atoms)
+
+        chains = self.codes['c'][matched].tolist()
+        summary = _chain_summary(
+            zip([names[c] for c in chains], atom_area[matched].tolist()))
+
+        a, b = self._oriented(first, index, reverse)
+        chain = self.codes['c']
+        pairs, pair_codes = np.unique(
+            np.stack((chain[a], chain[b]), axis=1), axis=0, return_inverse=True)
+        pair_codes = pair_codes.reshape(-1)
+        totals = {'chain_pairs': _group_totals(
+            ['{}-{}'.format(names[x], names[y]) for x, y in pairs.tolist()],
+            pair_codes, self.area[index])}
+
+        for group, (group_names, codes) in self.groups.items():
+            totals[group] = _group_totals(group_names, codes[atoms], area)
+        return summary, _details(totals)
+
+    def _oriented(self, first, index, reverse):
+        """Atoms of selected contacts ordered as output lines,
+        atom matching first selection first"""
+        a = np.where(reverse, self.second[index], self.first[index])
+        b = np.where(reverse, self.first[index], self.second[index])
+        swap = ~first[a] & first[b]
+        return np.where(swap, b, a), np.where(swap, a, b)
+
+    def residue_matrix(self, query, selected=None):
+        """Sparse residue by residue matrix of selected contacts in
+        coordinate format: names of residues, row, column, contact area and
+        minimal distance of every nonzero cell. Rows are residues of atoms
+        matching first selection"""
+        index, reverse = selected if selected is not None else self.select(query)
+        if not len(index):
+            return {'residues': [], 'rows': [], 'cols': [], 'area': [], 'dist': []}
+        first = self.match_atoms(query.first, query.first_not)
+        a, b = self._oriented(first, index, reverse)
+        names, codes = self.groups['residues']
+
+        # group by cell: sort contacts by cell and reduce runs of equal cells
+        cells = codes[a].astype(np.int64) * len(names) + codes[b]
+        order = np.argsort(cells, kind='stable')
+        cells = cells[order]
+        starts = np.flatnonzero(np.r_[True, cells[1:] != cells[:-1]])
+        area = np.add.reduceat(self.area[index][order], starts)
+        dist = np.minimum.reduceat(self.dist[index][order], starts)
+
+        # numbered by residues present in the matrix only
+        cells = cells[starts]
+        used, positions = np.unique(
+            np.concatenate((cells // len(names), cells % len(names))), return_inverse=True)
+        positions = positions.reshape(-1)
+        return {
+            'residues': [names[i] for i in used.tolist()],
+            'rows': positions[:len(cells)].tolist(),
+            'cols': positions[len(cells):].tolist(),
+            'area': np.round(area, 3).tolist(),
+            'dist': np.round(dist, 3).tolist(),
+        }
+
+    def lines(self, query, selected=None):
+        """Selected lines of contacts file as query-contacts would output them"""
+        index, reverse = selected if selected is not None else self.select(query)
+        if not len(index):
+            return b''
+
+        output = list()
+        with open(self.contacts_file, 'rb') as fh:
+            data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for i, rev in zip(index.tolist(), reverse.tolist()):
+                    line = data[self.start[i]:self.end[i]]
+                    if rev:
+                        a, b, rest = line.split(b' ', 2)
+                        line = b' '.join((b, a, rest))
+                    if not line.endswith(b'\n'):
+                        line += b'\n'
+                    output.append(line)
+            finally:
+                data.close()
+        return b''.join(output)
+
+    def query(self, query):
+        """Returns (selected lines, summary, details) from a single selection"""
+        selected = self.select(query)
+        summary, details = self.summarize(query, selected)
+        return self.lines(query, selected), summary, details
+
+
+def _chain_summary(atom_totals):
+    """Sums (chain, atom area) pairs by chain.
+    voronota prints sum of every atom with 6 significant digits and the
+    pair with c<any> first when chain name sorts after 'any'"""
+    summary = dict()
+    for chain, total in atom_totals:
+        name = min(chain, 'any')
+        summary[name] = summary.get(name, 0) + float('%.6g' % total)
+    return dict(sorted(summary.items()))
+
+
+def _group_totals(names, codes, area):
+    """Yields (name, area, contacts) of codes grouped by np.bincount"""
+    count = np.bincount(codes, minlength=len(names))
+    total = np.bincount(codes, weights=area, minlength=len(names))
+    for i in np.flatnonzero(count).tolist():
+        yield names[i], total[i], int(count[i])
+
+
+def _details(totals):
+    """Details of summary from {group: (name, area, contacts)}"""
+    return {group: {name: [round(float(area), 3), count]
+                    for name, area, count in sorted(rows)}
+            for group, rows in totals.items()}
+
+
+def _match_descriptor(values, selection):
+    """Pure python match of parsed descriptor with parsed selection"""
+    for alternative in selection:
+        for marker, terms in alternative:
+            value = values.get(marker, NULL_NUM if marker in NUMERIC_MARKERS else '')
+            if marker in NUMERIC_MARKERS:
+                matched = any(low <= value <= high for low, high in terms)
+            else:
+                matched = value in terms
+            if not matched:
+                break
+        else:
+            return True
+    return False
+
+
+class Summary(object):
+    """Streaming summary of query-contacts output, used when contacts are
+    selected by voronota. Output is fed in blocks of any size which are
+    split into lines in bulk, each atom descriptor is parsed only once"""
+    def __init__(self, query):
+        self.query = query
+        # descriptor -> [chain, matches first selection, area, contacts]
+        self._atoms = dict()
+        # (chain, chain) -> [area, contacts]
+        self._pairs = dict()
+        self._rest = b''
+
+    def _atom(self, descriptor):
+        values = parse_descriptor(descriptor.decode())
+        for marker in NUMERIC_MARKERS:
+            if marker in values:
+                values[marker] = int(values[marker])
+        positive, negative = self.query.first, self.query.first_not
+        matched = ((positive is None or _match_descriptor(values, positive)) and
+                   (negative is None or not _match_descriptor(values, negative)))
+        atom = self._atoms[descriptor] = [values.get('c', ''), matched, 0.0, 0]
+        return atom
+
+    def feed(self, block):
+        """Adds block of output"""
+        end = block.rfind(b'\n') + 1
+        if not end:
+            self._rest += block
+            return
+        lines = (self._rest + block[:end]).split(b'\n')
+        self._rest = block[end:]
+        self.add_lines(lines)
+
+    def add_lines(self, lines):
+        """Adds whole output lines"""
+        atoms, pairs = self._atoms, self._pairs
+        for line in lines:
+            fields = line.split(b' ', 3)
+            if len(fields) < 4:
+                continue
+            area = float(fields[2])
+            a = atoms.get(fields[0]) or self._atom(fields[0])
+            b = atoms.get(fields[1]) or self._atom(fields[1])
+            if a[1]:
+                a[2] += area
+                a[3] += 1
+            if b[1]:
+                b[2] += area
+                b[3] += 1
+                if not a[1]:
+                    a, b = b, a
+            pair = pairs.get((a[0], b[0]))
+            if pair is None:
+                pair = pairs[(a[0], b[0])] = [0.0, 0]
+            pair[0] += area
+            pair[1] += 1
+
+    def result(self):
+        """Returns (summary, details) as ContactIndex.summarize does"""
+        if self._rest:
+            self.add_lines([self._rest])
+            self._rest = b''
+
+        matched = [(d, atom) for d, atom in self._atoms.items() if atom[1]]
+        summary = _chain_summary((atom[0], atom[2]) for _, atom in matched)
+
+        groups = {'residues': (residue_name, dict()),
+                  'atom_classes': (atom_class, dict())}
+        for descriptor, atom in matched:
+            values = parse_descriptor(descriptor.decode())
+            for name, totals in groups.values():
+                total = totals.setdefault(name(values), [0.0, 0])
+                total[0] += atom[2]
+                total[1] += atom[3]
+
+        totals = {group: [(k, v[0], v[1]) for k, v in data.items()]
+                  for group, (_, data) in groups.items()}
+        totals['chain_pairs'] = [('{}-{}'.format(*k), v[0], v[1])
+                                 for k, v in self._pairs.items()]
+        return summary, _details(totals)
+
+
+def stats():
+    """Hit and miss counters and number of structures in the index"""
+    with _indexes_lock:
+        data = dict(_counters)
+        data['entries'] = len(_indexes)
+    lookups = data['hits'] + data['misses']
+    data['hit_ratio'] = float(data['hits']) / lookups if lookups else 0.0
+    return data
+
+
+def get(contacts_file):
+    """Returns index of contacts file, parsing it if it is not in memory.
+    At most INDEX_SIZE structures are kept"""
+    stat = os.stat(contacts_file)
+    version = (stat.st_ino, stat.st_mtime, stat.st_size)
+
+    with _indexes_lock:
+        entry = _indexes.get(contacts_file)
+        if entry is not None and entry[0] == version:
+            _indexes.move_to_end(contacts_file)
+            _counters['hits'] += 1
+            return entry[1]
+        _counters['misses'] += 1
+
+    return _index_flight.do(contacts_file, _load, contacts_file, version)
+
+
+def _load(contacts_file, version):
+    index = ContactIndex(contacts_file)
+    logging.debug("Contacts index of {} loaded: {} contacts".format(
+        contacts_file, len(index)))
+
+    with _indexes_lock:
+        _indexes[contacts_file] = (version, index)
+        _indexes.move_to_end(contacts_file)
+        while len(_indexes) > INDEX_SIZE:
+            _indexes.popitem(last=False)
+    return index
+
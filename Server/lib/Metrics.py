@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""Latency histograms of request stages and server gauges.
+
+Stages:
+    request   - whole framed request or legacy GETCGO
+    upload    - receiving and storing a structure
+    queue     - waiting for a free voronota slot
+    contacts  - calculating contacts (tessellation)
+    query     - selecting and summarizing contacts
+    drawing   - draw-contacts, runs along with query when voronota
+                selects contacts
+    transfer  - sending response to the client
+
+Values are returned by STATS and served in Prometheus text format by
+serve()."""
+
+import time
+import bisect
+import logging
+import threading
+import contextlib
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+
+# upper bounds of histogram buckets in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+PREFIX = 'vcontacts_'
+
+_histograms = dict()
+_connections = 0
+_lock = threading.Lock()
+
+
+class Histogram(object):
+    """Counts of observations by bucket, their sum and number"""
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def snapshot(self):
+        """{count, sum, buckets}, buckets are cumulative [bound, count]
+        pairs, the last bound is None (+Inf)"""
+        buckets = list()
+        total = 0
+        for bound, count in zip(BUCKETS + (None,), self.counts):
+            total += count
+            buckets.append([bound, total])
+        return {'count': self.count, 'sum': round(self.sum, 6), 'buckets': buckets}
+
+
+def observe(stage, seconds):
+    """Adds duration of a stage"""
+    with _lock:
+        histogram = _histograms.get(stage)
+        if histogram is None:
+            histogram = _histograms[stage] = Histogram()
+        histogram.observe(seconds)
+
+
+@contextlib.contextmanager
+def timed(stage):
+    """Observes duration of the block, also when it raises"""
+    started = time.time()
+    try:
+        yield
+    finally:
+        observe(stage, time.time() - started)
+
+
+def connection_opened():
+    global _connections
+    with _lock:
+        _connections += 1
+
+
+def connection_closed():
+    global _connections
+    with _lock:
+        _connections -= 1
+
+
+def stages():
+    """Histograms of all stages observed so far"""
+    with _lock:
+        return {stage: histogram.snapshot()
+                for stage, histogram in sorted(_histograms.items())}
+
+
+def connections():
+    """Number of client connections being served"""
+    with _lock:
+        return _connections
+
+
+def exposition(stats):
+    """Formats stats in Prometheus text format. Histograms under 'stages'
+    become one histogram labelled by stage, other numbers are gauges named
+    by their path in stats"""
+    lines = list()
+    name = PREFIX + 'stage_seconds'
+    lines.append('# TYPE {} histogram'.format(name))
+    for stage, histogram in stats.get('stages', {}).items():
+        for bound, count in histogram['buckets']:
+            lines.append('{}_bucket{{stage="{}",le="{}"}} {}'.format(
+                name, stage, '+Inf' if bound is None else bound, count))
+        lines.append('{}_sum{{stage="{}"}} {}'.format(name, stage, histogram['sum']))
+        lines.append('{}_count{{stage="{}"}} {}'.format(name, stage, histogram['count']))
+
+    def gauges(prefix, values):
+        for key, value in sorted(values.items()):
+            if key == 'stages':
+                continue
+            if isinstance(value, dict):
+                gauges(prefix + key + '_', value)
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                lines.append('# TYPE {}{} gauge'.format(prefix, key))
+                lines.append('{}{} {}'.format(prefix, key, value))
+    gauges(PREFIX, stats)
+    return '\n'.join(lines) + '\n'
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(port, collect):
+    """Serves exposition of collect() on localhost port in a background
+    thread. Returns the HTTP server"""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = exposition(collect()).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logging.debug("Metrics: {}".format(format % args))
+
+    server = _ThreadingHTTPServer(('127.0.0.1', int(port)), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    logging.info("Metrics are served on 127.0.0.1:{}".format(port))
+    return server
@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+"""Request handlers shared by both server engines.
+
+Handlers take the client session (ClientHandler or AsyncClientHandler),
+request meta and payload and return (meta, payload) of the response.
+They may block, asynchronous engine runs them on its executor."""
+
+import os
+import binascii
+import logging
+import tempfile
+import contextlib
+import sys
+
+python3 = sys.version_info >= (3,0)
+
+if python3:
+    from . import Workspace
+    from . import Voronota
+    from . import Protocol
+    from . import ResultCache
+    from . import ContactIndex
+    from . import Metrics
+    from . import Tracing
+    from . import CGO
+else:
+    import Workspace
+    import Voronota
+    import Protocol
+    import ResultCache
+    import ContactIndex
+    import Metrics
+    import Tracing
+    import CGO
+
+
+@contextlib.contextmanager
+def request(session, name):
+    """Traces, times and, if it is sampled, profiles a request of session.
+    Must run in the thread doing the work"""
+    with Tracing.trace(session.trace_id), Tracing.profiled(name), \
+            Tracing.span(name), Metrics.timed('request'):
+        yield
+
+
+def legacy_get(session, file_name, query, params):
+    """GETCGO of the legacy protocol, see query_contacts"""
+    with request(session, 'GETCGO'):
+        return query_contacts(session, file_name, query, params)
+
+
+def query_contacts(session, file_name, query, params, inline=False,
+                   details=False, matrix=False, ID=None):
+    """Runs query against stored structure, ID names the drawing and
+    defaults to client port. Returns data sent to client or None on
+    server error.
+    With inline drawing is returned as 'cgo' bytes instead of a path
+    to the draw file, which is then removed. With details data also holds
+    area and contacts by chain pair, residue and atom class, with matrix
+    sparse residue by residue contact area and minimal distance"""
+    with Workspace.in_use(file_name):
+        data = _query_contacts(
+            session.port if ID is None else ID, file_name, query, params,
+            inline, details, matrix)
+        Workspace.record_usage(file_name)
+    return data
+
+
+def _query_contacts(ID, file_name, query, params, inline, details=False,
+                    matrix=False):
+    """query_contacts of structure already in use, ID names the drawing"""
+    key = ResultCache.make_key(file_name, query, params)
+    name = Voronota.drawing_name(ID)
+    path = Workspace.mkdir(file_name)
+    if not inline:
+        draw_file = Workspace.construct_file_path(path, 'draw' + str(ID))
+
+    cached = ResultCache.get(key)
+    if cached is not None:
+        summary, cached_name, cgo, summary_details = cached
+        if cached_name != name:
+            cgo = cgo.replace(cached_name.encode(), name.encode())
+        if not inline:
+            _write_draw_file(draw_file, cgo)
+    else:
+        if not Voronota.create_contacts_file(file_name):
+            return None
+        if inline:
+            fd, draw_file = tempfile.mkstemp(prefix='.draw-', dir=path)
+            os.close(fd)
+        else:
+            # draw-contacts writes nothing when no contacts are selected
+            Workspace.delete_file(draw_file)
+        try:
+            result = Voronota.query(file_name, query, ID, params, draw_file)
+            if result is None:
+                return None
+            summary, summary_details = result
+            cgo = b''
+            if os.path.exists(draw_file):
+                with open(draw_file, 'rb') as fh:
+                    cgo = fh.read()
+        finally:
+            if inline:
+                Workspace.delete_file(draw_file)
+        ResultCache.put(key, summary, name, cgo, summary_details)
+
+    data = {'summary': summary}
+    if details:
+        data['details'] = summary_details
+    if matrix:
+        # cache hits don't need contacts file, matrix is read from it
+        if not Voronota.create_contacts_file(file_name):
+            return None
+        data['matrix'] = Voronota.residue_matrix(file_name, query, params)
+    if inline:
+        data['cgo'] = cgo
+    else:
+        data['path'] = draw_file
+    return data
+
+
+def _write_draw_file(draw_file, cgo):
+    """Writes cached drawing as draw-contacts would, nothing if it is empty"""
+    if not cgo:
+        Workspace.delete_file(draw_file)
+        return
+    with open(draw_file, 'wb') as fh:
+        fh.write(cgo)
+
+
+def check_file(session, meta, payload):
+    """CHECKFILE: meta = {name, checksum}"""
+    file_name = meta['name'].lower()
+    checksum = meta['checksum']
+
+    if not Workspace.file_check_checksum(checksum):
+        return {'status': 'NOTFOUND'}, b''
+
+    session.aliases[file_name] = checksum
+    Workspace.set_alias(file_name, checksum)
+    return {'status': 'OK'}, b''
+
+
+def send_file(session, meta, payload):
+    """SENDFILE: meta = {name[, encoding]}, payload = structure file,
+    compressed if encoding is given"""
+    file_name = meta['name'].lower()
+    with Metrics.timed('upload'):
+        digest = Workspace.store_file(
+            Protocol.decompress_stream([payload], meta.get('encoding')), file_name)
+    session.aliases[file_name] = digest
+    Voronota.precompute_contacts(digest)
+    return {'status': 'OK', 'checksum': digest}, b''
+
+
+def chunks(session, meta, payload):
+    """CHUNKS: meta = {name, checksum}, payload = concatenated SHA-256
+    digests of structure chunks. Responds with indices of missing chunks"""
+    digests = [binascii.hexlify(payload[i:i + 32]).decode()
+               for i in range(0, len(payload), 32)]
+    session.manifests[meta['checksum']] = digests
+    return {'status': 'OK', 'missing': Workspace.missing_chunks(digests)}, b''
+
+
+def put_chunks(session, meta, payload):
+    """PUTCHUNKS: meta = {name, checksum, sizes[, encoding]}, payload =
+    chunks reported missing by CHUNKS. Assembles structure from chunks"""
+    file_name = meta['name'].lower()
+    digests = session.manifests.pop(meta['checksum'])
+
+    with Metrics.timed('upload'):
+        data = b''.join(Protocol.decompress_stream([payload], meta.get('encoding')))
+        offset = 0
+        for size in meta['sizes']:
+            Workspace.store_chunk(data[offset:offset + size])
+            offset += size
+
+        missing = Workspace.missing_chunks(digests)
+        if missing:
+            return {'status': 'NOTFOUND', 'missing': missing}, b''
+
+        digest = Workspace.assemble_chunks(digests)
+    if digest != meta['checksum']:
+        raise ValueError("Assembled structure checksum mismatch")
+    # name refers to the structure only once it is verified
+    Workspace.set_alias(file_name, digest)
+    session.aliases[file_name] = digest
+    Voronota.precompute_contacts(digest)
+    return {'status': 'OK', 'checksum': digest}, b''
+
+
+def _drawing(data, binary):
+    """Pops drawing script from data. With binary it is returned packed
+    by CGO.pack, its name and format ('float32', or 'script' if drawing
+    can't be packed) are set in data"""
+    cgo = data.pop('cgo')
+    if not binary:
+        return cgo
+    try:
+        with Metrics.timed('drawing'), Tracing.span('pack'):
+            data['name'], cgo = CGO.pack(cgo)
+        data['format'] = 'float32'
+    except ValueError as e:
+        logging.warning("Drawing is sent as script: {}".format(e))
+        data['format'] = 'script'
+    return cgo
+
+
+def _request_name(session, meta):
+    """Names drawings of framed request by client port and request id"""
+    if meta.get('id') is None:
+        return session.port
+    return '{}_{}'.format(session.port, meta['id'])
+
+
+def get_cgo(session, meta, payload):
+    """GETCGO: meta = {name, filter, params[, cgo, encoding, details,
+    matrix]}, name may be a checksum. With cgo = 'inline' drawing is sent
+    as payload compressed with given encoding, with cgo = 'binary' it is
+    sent packed as float32 CGO array, see _drawing. With details response
+    holds details of the summary, with matrix residue contact matrix as
+    {residues, rows, cols, area, dist}, each null if it is not known for
+    the query. Drawing is named vcontacts_<port>_<request id>, so drawings
+    of one connection don't replace each other"""
+    file_name = session.resolve(meta['name'])
+    if file_name is None:
+        return {'status': 'NOTFOUND'}, b''
+
+    inline = meta.get('cgo') in ('inline', 'binary')
+    data = query_contacts(session, file_name, meta['filter'], meta['params'],
+                          inline, bool(meta.get('details')),
+                          bool(meta.get('matrix')), _request_name(session, meta))
+    if data is None:
+        return {'status': 'SERVERERROR'}, b''
+
+    data['status'] = 'OK'
+    if not inline:
+        return data, b''
+
+    encoding = meta.get('encoding')
+    data['encoding'] = encoding
+    cgo = _drawing(data, meta.get('cgo') == 'binary')
+    return data, Protocol.compress(cgo, encoding)
+
+
+def batch(session, meta, payload):
+    """BATCH: meta = {name, queries[, cgo, encoding, details, matrix]},
+    queries is a list of {filter, params} run against one structure.
+    Response results hold status, summary and drawing size of every query
+    (and details, matrix and with cgo = 'binary' drawing name and format
+    like GETCGO) in the same order, status of a malformed query is
+    BADREQUEST and of a failed one SERVERERROR,
+    payload holds the drawings one after another, each compressed with
+    given encoding. Drawings are named
+    vcontacts_<port>_<request id>_<query index>"""
+    file_name = session.resolve(meta['name'])
+    if file_name is None:
+        return {'status': 'NOTFOUND'}, b''
+
+    encoding = meta.get('encoding')
+    results = list()
+    drawings = list()
+    name = _request_name(session, meta)
+    with Workspace.in_use(file_name):
+        for i, query in enumerate(meta['queries']):
+            # a failed query doesn't discard results of the others
+            try:
+                data = _query_contacts('{}_{}'.format(name, i), file_name,
+                                       query['filter'], query['params'], True,
+                                       bool(meta.get('details')),
+                                       bool(meta.get('matrix')))
+            except (KeyError, TypeError, ValueError) as e:
+                logging.error("Bad BATCH query {} from {}:{}: {}".format(
+                    i, session.host, session.port, e))
+                results.append({'status': 'BADREQUEST', 'size': 0})
+                continue
+            except Exception as e:
+                logging.error("BATCH query {} failed for {}:{}: {}".format(
+                    i, session.host, session.port, e))
+                data = None
+            if data is None:
+                results.append({'status': 'SERVERERROR', 'size': 0})
+                continue
+            cgo = Protocol.compress(
+                _drawing(data, meta.get('cgo') == 'binary'), encoding)
+            data.update(status='OK', size=len(cgo))
+            results.append(data)
+            drawings.append(cgo)
+        Workspace.record_usage(file_name)
+
+    return {'status': 'OK', 'encoding': encoding, 'results': results}, b''.join(drawings)
+
+
+def ping(session, meta, payload):
+    """PING: health check of a kept connection"""
+    return {'status': 'OK'}, b''
+
+
+def server_stats():
+    """Counters, gauges and stage latency histograms of the server"""
+    return {
+        'cache': ResultCache.stats(),
+        'index': ContactIndex.stats(),
+        'jobs': Voronota.jobs_stats(),
+        'connections': Metrics.connections(),
+        'workspace_bytes': Workspace.disk_usage(),
+        'stages': Metrics.stages(),
+    }
+
+
+def stats(session, meta, payload):
+    """STATS: counters of the server, see server_stats"""
+    data = server_stats()
+    data['status'] = 'OK'
+    return data, b''
+
+
+OPERATIONS = {
+    'CHECKFILE': check_file,
+    'SENDFILE': send_file,
+    'CHUNKS': chunks,
+    'PUTCHUNKS': put_chunks,
+    'GETCGO': get_cgo,
+    'BATCH': batch,
+    'STATS': stats,
+    'PING': ping,
+}
+
+
+def dispatch(session, meta, payload):
+    """Handles framed request, returns response (meta, payload)"""
+    operation = OPERATIONS.get(meta.get('op'))
+
+    if operation is None:
+        resp_meta, resp_payload = {'status': 'BADREQUEST'}, b''
+    else:
+        try:
+            with request(session, meta['op']):
+                resp_meta, resp_payload = operation(session, meta, payload)
+        except (KeyError, TypeError, ValueError) as e:
+            logging.error("Bad {} request from {}:{}: {}".format(
+                meta.get('op'), session.host, session.port, e))
+            resp_meta, resp_payload = {'status': 'BADREQUEST'}, b''
+        except Exception as e:
+            logging.error("{} failed for {}:{}: {}".format(
+                meta.get('op'), session.host, session.port, e))
+            resp_meta, resp_payload = {'status': 'SERVERERROR'}, b''
+
+    resp_meta['id'] = meta.get('id')
+    resp_meta['trace'] = session.trace_id
+    logging.debug("Server: Response send to {}:{} response: {} {}".format(
+        session.host, session.port, meta.get('op'), resp_meta['status']))
+    return resp_meta, resp_payload
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""Framed protocol (version 2).
+
+Client starts with a legacy style 'HELLO 2' request, server answers
+'OK 2 <features>' and from then on every message in both directions is
+a frame: <meta size><payload size> header (two network order uint32),
+json encoded meta and raw payload. Requests carry an 'id' which is
+copied to the response, so a client may send several requests without
+waiting for responses."""
+
+import json
+import struct
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+VERSION = 2
+
+# Payload compressions supported by this server
+ENCODINGS = ['zlib'] + (['lzma'] if lzma else [])
+
+FEATURES = ['pipeline', 'inline-cgo', 'compressed-upload', 'chunks', 'stats', 'batch', 'details', 'matrix', 'binary-cgo', 'ping'] + ENCODINGS
+
+HEADER = struct.Struct('!II')
+MAX_META_SIZE = 1 << 20
+
+
+class ProtocolError(ValueError): pass
+
+
+def hello_response():
+    """Response to HELLO request"""
+    return "OK {} {}".format(VERSION, ','.join(FEATURES))
+
+
+def pack_header(meta, payload_size=0):
+    """Returns frame header and encoded meta.
+    Payload is sent separately to avoid copying it"""
+    meta = json.dumps(meta).encode()
+    return HEADER.pack(len(meta), payload_size) + meta
+
+
+def unpack_header(data):
+    """Returns (meta size, payload size)"""
+    meta_size, payload_size = HEADER.unpack(data)
+    if meta_size > MAX_META_SIZE:
+        raise ProtocolError("Frame meta too large: {}".format(meta_size))
+    return meta_size, payload_size
+
+
+def unpack_meta(data):
+    meta = json.loads(data.decode())
+    if not isinstance(meta, dict):
+        raise ProtocolError("Frame meta must be an object")
+    return meta
+
+
+def compress(data, encoding):
+    """Compresses payload with one of ENCODINGS, None means no compression"""
+    if not encoding:
+        return data
+    if encoding == 'zlib':
+        return zlib.compress(data)
+    if encoding == 'lzma' and lzma:
+        return lzma.compress(data)
+    raise ProtocolError("Unsupported encoding: {}".format(encoding))
+
+
+def decompressor(encoding):
+    if encoding == 'zlib':
+        return zlib.decompressobj()
+    if encoding == 'lzma' and lzma:
+        return lzma.LZMADecompressor()
+    raise ProtocolError("Unsupported encoding: {}".format(encoding))
+
+
+def decompress_stream(chunks, encoding):
+    """Yields decompressed content of compressed chunks"""
+    if not encoding:
+        for chunk in chunks:
+            yield chunk
+        return
+
+    stream = decompressor(encoding)
+    for chunk in chunks:
+        yield stream.decompress(chunk)
+    if hasattr(stream, 'flush'):
+        yield stream.flush()
+    if not stream.eof:
+        raise ProtocolError("Compressed stream is incomplete")
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""Cache of GETCGO results.
+
+Drawing, summary and details of a query are stored under a key made of structure
+digest, filter and params. Recently used results are kept in memory
+(RESULT_CACHE_MEMORY bytes), results pushed out of memory are kept on
+disk (RESULT_CACHE_DISK bytes) in RESULTS_DIR of the workspace. Both
+levels drop least recently used results first."""
+
+import os
+import json
+import hashlib
+import logging
+import tempfile
+import threading
+
+from collections import OrderedDict
+
+from . import Workspace
+from .Config import *
+
+
+# key -> (summary, drawing name, drawing, details)
+_memory = OrderedDict()
+_memory_size = 0
+# key -> size of the file on disk, None until disk directory is listed
+_disk = None
+_disk_size = 0
+_lock = threading.Lock()
+
+_counters = {'hits': 0, 'disk_hits': 0, 'misses': 0}
+
+
+def make_key(digest, query, params):
+    """Normalized key of the query: whitespace of the filter and order of
+    params do not matter, filter flags are compared by name only"""
+    key = [
+        digest,
+        ' '.join(query.split()),
+        sorted(params['query'].keys()),
+        sorted((str(k), str(v)) for k, v in params['drawing'].items()),
+    ]
+    return hashlib.sha256(json.dumps(key).encode()).hexdigest()
+
+
+def stats():
+    """Hit and miss counters and current size of the cache"""
+    with _lock:
+        data = dict(_counters)
+        data['memory_entries'] = len(_memory)
+        data['memory_bytes'] = _memory_size
+        data['disk_entries'] = len(_disk) if _disk is not None else 0
+        data['disk_bytes'] = _disk_size
+    lookups = data['hits'] + data['misses']
+    data['hit_ratio'] = float(data['hits']) / lookups if lookups else 0.0
+    return data
+
+
+def get(key):
+    """Returns (summary, drawing name, drawing, details) or None"""
+    with _lock:
+        entry = _memory.get(key)
+        if entry is not None:
+            _memory.move_to_end(key)
+            _counters['hits'] += 1
+            return entry
+        on_disk = _load_disk_index().get(key) is not None
+
+    entry = _read(key) if on_disk else None
+
+    with _lock:
+        if entry is None:
+            _counters['misses'] += 1
+            return None
+        _counters['hits'] += 1
+        _counters['disk_hits'] += 1
+        if key in _disk:
+            _disk.move_to_end(key)
+    _put_memory(key, entry)
+    return entry
+
+
+def put(key, summary, name, drawing, details=None):
+    """Stores result of the query"""
+    _put_memory(key, (summary, name, drawing, details))
+
+
+def _entry_size(entry):
+    return len(entry[2]) + len(json.dumps([entry[0], entry[3]]))
+
+
+def _put_memory(key, entry):
+    """Adds entry to memory, entries pushed out go to disk"""
+    global _memory_size
+
+    evicted = list()
+    with _lock:
+        if key in _memory:
+            _memory.move_to_end(key)
+            return
+        _memory[key] = entry
+        _memory_size += _entry_size(entry)
+        while _memory and _memory_size > RESULT_CACHE_MEMORY:
+            old_key, old_entry = _memory.popitem(last=False)
+            _memory_size -= _entry_size(old_entry)
+            if old_key not in _load_disk_index():
+                evicted.append((old_key, old_entry))
+
+    for old_key, old_entry in evicted:
+        _write(old_key, old_entry)
+
+
+def _results_dir():
+    return os.path.join(SERVER_DIR, Workspace.RESULTS_DIR)
+
+
+def _load_disk_index():
+    """Lists results directory on first use, oldest files first.
+    Must be called with _lock held"""
+    global _disk, _disk_size
+
+    if _disk is None:
+        _disk = OrderedDict()
+        _disk_size = 0
+        directory = _results_dir()
+        files = list()
+        if os.path.isdir(directory):
+            for file_name in os.listdir(directory):
+                if file_name.startswith('.'):
+                    continue
+                stat = os.stat(os.path.join(directory, file_name))
+                files.append((stat.st_mtime, file_name, stat.st_size))
+        for _, file_name, size in sorted(files):
+            _disk[file_name] = size
+            _disk_size += size
+    return _disk
+
+
+def _write(key, entry):
+    """Stores entry on disk, drops oldest files over RESULT_CACHE_DISK"""
+    global _disk_size
+
+    summary, name, drawing, details = entry
+    if RESULT_CACHE_DISK <= 0 or len(drawing) > RESULT_CACHE_DISK:
+        return
+
+    directory = Workspace.mkdir(Workspace.RESULTS_DIR)
+    header = json.dumps(
+        {'summary': summary, 'name': name, 'details': details}).encode() + b'\n'
+    fd, tmp_file = tempfile.mkstemp(prefix='.result-', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(header)
+            fh.write(drawing)
+        os.replace(tmp_file, os.path.join(directory, key))
+    except Exception as e:
+        logging.error("Storing query result: {}".format(e))
+        Workspace.delete_file(tmp_file)
+        return
+
+    removed = list()
+    with _lock:
+        disk = _load_disk_index()
+        _disk_size -= disk.pop(key, 0)
+        disk[key] = len(header) + len(drawing)
+        _disk_size += disk[key]
+        while _disk_size > RESULT_CACHE_DISK:
+            old_key, size = disk.popitem(last=False)
+            _disk_size -= size
+            removed.append(old_key)
+
+    for old_key in removed:
+        Workspace.delete_file(os.path.join(directory, old_key))
+
+
+def _read(key):
+    """Reads entry from disk, None if it is gone"""
+    global _disk_size
+
+    file_path = os.path.join(_results_dir(), key)
+    try:
+        with open(file_path, 'rb') as fh:
+            header = json.loads(fh.readline().decode())
+            drawing = fh.read()
+        # keeps order of use for the next start
+        os.utime(file_path, None)
+    except (IOError, OSError, ValueError):
+        with _lock:
+            _disk_size -= _load_disk_index().pop(key, 0)
+        return None
+    return header['summary'], header['name'], drawing, header.get('details')
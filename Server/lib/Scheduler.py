@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+import contextlib
+
+
+class Scheduler(object):
+    """Limits number of jobs running at once.
+    When a slot frees up the cheapest waiting job gets it, so small
+    interactive queries are not stuck behind large structures. Cost of
+    a waiting job halves every aging seconds, so large jobs still run"""
+    def __init__(self, slots, aging=10.0):
+        self.slots = slots
+        self.aging = aging
+        self._cond = threading.Condition()
+        self._running = 0
+        # [cost, queued at, sequence number] of waiting jobs
+        self._waiting = list()
+        self._sequence = 0
+
+    def _priority(self, job, now):
+        cost, queued, sequence = job
+        return cost * 0.5 ** ((now - queued) / self.aging), sequence
+
+    def _next(self):
+        now = time.time()
+        return min(self._waiting, key=lambda job: self._priority(job, now))
+
+    @contextlib.contextmanager
+    def slot(self, cost):
+        """Waits for a free slot, cost is an estimate of job size"""
+        with self._cond:
+            self._sequence += 1
+            job = [cost, time.time(), self._sequence]
+            self._waiting.append(job)
+            while self._running >= self.slots or self._next() is not job:
+                self._cond.wait()
+            self._waiting.remove(job)
+            self._running += 1
+            # another slot may be free for the next job in line
+            self._cond.notify_all()
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._running -= 1
+                self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {'slots': self.slots, 'running': self._running,
+                    'queued': len(self._waiting)}
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+import threading
+
+
+class _Call(object):
+    """Function call shared by concurrent callers"""
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+
+class SingleFlight(object):
+    """Runs at most one call per key at a time.
+    Concurrent callers with the same key wait for and share its result"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = dict()
+
+    def do(self, key, function, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+
+        if not leader:
+            call.done.wait()
+            return call.result
+
+        try:
+            call.result = function(*args, **kwargs)
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
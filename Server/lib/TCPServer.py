@@ -4,25 +4,43 @@ import socket
 import time
 import logging
 import sys
+import threading
+import functools
+import selectors
 
 python3 = sys.version_info >= (3,0)
 
 if python3:
-    from _thread import start_new_thread
+    import queue
     from . import ClientHandler
 else:
-    from thread import start_new_thread
+    import Queue as queue
     import ClientHandler
 
 class TCPServer:
-    def __init__(self, host, port):
+    def __init__(self, host, port, workers=8, queue_size=32, backlog=10,
+                 idle_timeout=0):
         try:
             self.address = (host, int(port))
         except ValueError:
             raise ValueError("Port number must be numeric")
         self._serv_socket = None
-        self._acpt_conn_num = 10
+        self._acpt_conn_num = backlog
+        self._workers_num = workers
+        self._idle_timeout = idle_timeout
+        # jobs waiting for a free worker: accepted connections, at most
+        # queue_size of them, and parked connections with a new request
+        self._pending = queue.Queue()
+        self._queue_size = queue_size
+        self._workers = list()
         self._running = False
+        # framed connections waiting for their next request don't hold a
+        # worker, the poller watches them
+        self._selector = selectors.DefaultSelector()
+        self._parking = list()
+        self._parking_lock = threading.Lock()
+        self._wakeup, self._wakeup_write = socket.socketpair()
+        self._poller_thread = None
 
     def start(self):
         """Function for initializing, binding server socket and
@@ -37,25 +55,102 @@ class TCPServer:
 
         self._serv_socket.listen(self._acpt_conn_num)
         self._running = True
+
+        for _ in range(self._workers_num):
+            worker = threading.Thread(target=self._worker)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+        self._selector.register(self._wakeup, selectors.EVENT_READ)
+        self._poller_thread = threading.Thread(target=self._poller)
+        self._poller_thread.daemon = True
+        self._poller_thread.start()
+
         logging.info("Socket created, binded and now listening")
 
     def running(self):
         return self._running
 
+    def _worker(self):
+        """Runs pending jobs one at a time"""
+        while True:
+            job = self._pending.get()
+            if job is None:
+                break
+            try:
+                job()
+            except Exception as e:
+                logging.error("Lost connection with client. msg: {}".format(e))
+
+    def _serve(self, client_conn, client_addr):
+        ClientHandler.ClientHandler(
+            client_conn, client_addr, self._idle_timeout, self._park)
+
+    def _park(self, handler):
+        """Hands connection waiting for its next request to the poller"""
+        handler.parked_at = time.time()
+        with self._parking_lock:
+            self._parking.append(handler)
+        self._wakeup_write.send(b'\0')
+
+    def _poller(self):
+        """Queues parked connections with a new request for a worker and
+        closes ones idle for longer than idle timeout"""
+        while self._running:
+            with self._parking_lock:
+                parking, self._parking = self._parking, list()
+            for handler in parking:
+                self._selector.register(handler.conn, selectors.EVENT_READ, handler)
+
+            for key, _ in self._selector.select(timeout=1.0):
+                if key.fileobj is self._wakeup:
+                    self._wakeup.recv(4096)
+                    continue
+                self._selector.unregister(key.fileobj)
+                self._pending.put(key.data.resume)
+
+            if not self._idle_timeout:
+                continue
+            now = time.time()
+            for key in list(self._selector.get_map().values()):
+                handler = key.data
+                if handler is not None and now - handler.parked_at > self._idle_timeout:
+                    logging.debug("Client: {}:{} is idle, closing".format(
+                        handler.host, handler.port))
+                    self._selector.unregister(key.fileobj)
+                    handler.close()
+
     def acceptConnection(self):
         """Function for accepting client connections.
-        Function creates a new thread and passes client socket to clientHandler"""
+        Function queues client socket for a worker thread or
+        responds BUSY if the queue is full"""
         client_conn, client_addr = self._serv_socket.accept()
         logging.info("Connected with: {}:{}".format(*client_addr))
-        try:
-            tid = start_new_thread(ClientHandler.ClientHandler, (client_conn, client_addr))
-            logging.debug("Thread created. ID: {}".format(tid))
-        except Exception as e:
-            logging.error("Lost connection with client. msg: {}".format(e))
+        # clients keep connections open between queries
+        client_conn.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        # parked connections are always queued, new ones only while
+        # fewer than queue_size jobs wait
+        if self._pending.qsize() < self._queue_size:
+            self._pending.put(functools.partial(
+                self._serve, client_conn, client_addr))
+            logging.debug("Connection queued. Pending: {}".format(
+                self._pending.qsize()))
+        else:
+            logging.warning("Server is busy. Rejecting {}:{}".format(*client_addr))
+            try:
+                client_conn.sendall("BUSY".encode())
+                client_conn.shutdown(socket.SHUT_WR)
+            except socket.error:
+                pass
+            client_conn.close()
 
     def shutdown(self):
         """Server shutdown function"""
         self._serv_socket.shutdown(socket.SHUT_RDWR)
         self._serv_socket.close()
         self._running = False
+        self._wakeup_write.send(b'\0')
+        for _ in self._workers:
+            self._pending.put(None)
         logging.info("Server Shutdown")
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""Trace IDs and span timings of client requests.
+
+Every client session gets a trace ID. Spans (socket phases, voronota
+subprocesses) are logged with the trace ID of the request running in the
+current thread, their wall and CPU time and for subprocesses CPU time
+and peak RSS of the child processes reaped by wait in the span.
+
+With profiling enabled every n-th request is run under cProfile and its
+stats are dumped to the profiles directory, readable with pstats."""
+
+import os
+import time
+import uuid
+import logging
+import threading
+import contextlib
+
+try:
+    import cProfile
+except ImportError:
+    cProfile = None
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+_local = threading.local()
+
+# profile every n-th request, 0 - off
+_profile_every = 0
+_profile_dir = None
+_requests = 0
+_profile_lock = threading.Lock()
+
+# CPU time of the calling thread
+_thread_time = getattr(time, 'thread_time', time.process_time)
+
+
+def new_trace_id():
+    return uuid.uuid4().hex[:16]
+
+
+def current():
+    """Trace ID of the request running in this thread, '-' if none"""
+    return getattr(_local, 'trace_id', '-')
+
+
+@contextlib.contextmanager
+def trace(trace_id):
+    """Runs the block as part of request with trace_id"""
+    previous = getattr(_local, 'trace_id', None)
+    _local.trace_id = trace_id
+    try:
+        yield
+    finally:
+        _local.trace_id = previous
+
+
+def wait(process):
+    """Waits for subprocess.Popen process and returns its exit code.
+    Where os.wait4 is available its CPU time and peak RSS are added to
+    the innermost span with children running in this thread.
+    Peak RSS of a child includes RSS the server had when it was spawned,
+    it is only known if larger than peak RSS of the server itself"""
+    if resource is None or not hasattr(os, 'wait4') \
+            or process.returncode is not None:
+        return process.wait()
+    try:
+        _, status, usage = os.wait4(process.pid, 0)
+    except OSError:
+        # already reaped
+        return process.wait()
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+
+    spans = getattr(_local, 'children', None)
+    if spans:
+        totals = spans[-1]
+        totals[0] += 1
+        totals[1] += usage.ru_utime + usage.ru_stime
+        server_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if usage.ru_maxrss > server_peak:
+            totals[2] = max(totals[2], usage.ru_maxrss)
+        else:
+            totals[3] = max(totals[3], server_peak)
+    return process.returncode
+
+
+@contextlib.contextmanager
+def span(name, children=False, trace_id=None):
+    """Logs timings of the block. With children also number, CPU time and
+    the largest peak RSS of child processes reaped by wait in the block,
+    or the bound it is below if no child outgrew the server.
+    trace_id is needed where requests share a thread (event loop)"""
+    started, cpu = time.time(), _thread_time()
+    if children:
+        # [processes, CPU seconds, max RSS, bound of unknown max RSS] in KiB
+        totals = [0, 0.0, 0, 0]
+        if not hasattr(_local, 'children'):
+            _local.children = list()
+        _local.children.append(totals)
+    try:
+        yield
+    finally:
+        message = "Trace {} {}: wall {:.3f}s cpu {:.3f}s".format(
+            trace_id or current(), name, time.time() - started,
+            _thread_time() - cpu)
+        if children:
+            _local.children.pop()
+            if totals[0]:
+                message += " children {} cpu {:.3f}s".format(*totals)
+                if totals[2]:
+                    message += " maxrss {} KiB".format(totals[2])
+                elif totals[3]:
+                    message += " maxrss <= {} KiB".format(totals[3])
+        logging.debug(message)
+
+
+def enable_profiling(directory, every=10):
+    """Profiles every n-th request into directory"""
+    global _profile_every, _profile_dir
+
+    if cProfile is None:
+        logging.warning("cProfile is not available, requests are not profiled")
+        return
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    _profile_dir = directory
+    _profile_every = max(int(every), 1)
+    logging.info("Profiling every {} request into {}".format(
+        _profile_every, directory))
+
+
+@contextlib.contextmanager
+def profiled(name):
+    """Runs the block under cProfile if this request is sampled"""
+    global _requests
+
+    if not _profile_every:
+        yield
+        return
+    with _profile_lock:
+        _requests += 1
+        number = _requests
+    if number % _profile_every:
+        yield
+        return
+
+    profile = cProfile.Profile()
+    try:
+        profile.enable()
+    except ValueError:
+        # another profiler is active, interpreter allows only one
+        yield
+        return
+    try:
+        yield
+    finally:
+        profile.disable()
+        file_name = os.path.join(_profile_dir, '{}-{}-{}-{}.pstats'.format(
+            time.strftime('%Y%m%d-%H%M%S'), number, current(), name))
+        try:
+            profile.dump_stats(file_name)
+        except (IOError, OSError) as e:
+            logging.error("Saving profile: {}".format(e))
@@ -3,40 +3,111 @@
 import subprocess
 import logging
 import tempfile
+import time
 import os
 import sys
-import re
+import threading
+import contextlib
 
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 python3 = sys.version_info >= (3,0)
 
 if python3:
     from . import Workspace
+    from . import ContactIndex
+    from .SingleFlight import SingleFlight
+    from . import Metrics
+    from . import Tracing
+    from .Scheduler import Scheduler
     from .Config import *
 else:
     import Workspace
+    import ContactIndex
+    from SingleFlight import SingleFlight
+    import Metrics
+    import Tracing
+    from Scheduler import Scheduler
     from Config import *
 
+# Costs of voronota jobs are estimated as bytes of contacts they process,
+# contacts file is roughly this many times larger than its structure
+CONTACTS_COST_FACTOR = 100
+
+# Concurrent requests for the same structure share one contacts computation
+_contacts_flight = SingleFlight()
+
+# All voronota pipelines run through the scheduler
+_scheduler = Scheduler(MAX_JOBS or os.cpu_count() or 1)
+
+def jobs_stats():
+    """Running and queued voronota jobs"""
+    return _scheduler.stats()
+
+@contextlib.contextmanager
+def _job(cost, stage):
+    """Runs the block in a scheduler slot, observing time spent waiting
+    for the slot and running in it"""
+    started = time.time()
+    with _scheduler.slot(cost):
+        Metrics.observe('queue', time.time() - started)
+        with Metrics.timed(stage), Tracing.span(stage, children=True):
+            yield
+
+# Contacts of uploaded structures are calculated in background
+_background = None
+_background_lock = threading.Lock()
+
+def precompute_contacts(file_name):
+    """Starts contacts calculation of just stored structure in background.
+    Queries arriving meanwhile wait for it instead of starting their own"""
+    global _background
+
+    if not PRECOMPUTE:
+        return None
+    with _background_lock:
+        if _background is None:
+            _background = ThreadPoolExecutor(max_workers=_scheduler.slots)
+    logging.debug("Calculating contacts of {} in background".format(file_name))
+    return _background.submit(_precompute_contacts, file_name)
+
+def _precompute_contacts(file_name):
+    with Workspace.in_use(file_name):
+        return create_contacts_file(file_name)
+
 def create_contacts_file(file_name):
     """Creates contacts file"""
     # get paths
     path = Workspace.mkdir(file_name)
+    contacts_file = Workspace.construct_file_path(path, 'contacts')
+
+    if Workspace.file_exists(contacts_file,file_path_FLAG=True):
+        return True
+
+    return _contacts_flight.do(file_name, _calculate_contacts, file_name)
+
+def _calculate_contacts(file_name):
+    """Runs voronota and atomically moves its output to contacts file"""
+    path = Workspace.mkdir(file_name)
     pdb_file = Workspace.construct_file_path(path, file_name)
     contacts_file = Workspace.construct_file_path(path, 'contacts')
 
+    # finished while this call was waiting to become the leader
     if Workspace.file_exists(contacts_file,file_path_FLAG=True):
         return True
 
+    fd, tmp_file = tempfile.mkstemp(prefix='.contacts-', dir=path)
     try:
-        with open(pdb_file, 'r') as file:
+        with os.fdopen(fd, 'w') as fh, open(pdb_file, 'r') as file, \
+                _job(CONTACTS_COST_FACTOR * os.path.getsize(pdb_file), 'contacts'):
+            started = time.time()
             pipe = subprocess.Popen([
                 PROGRAM_PATH,
                 COMMAND_ATOMS,
                 ANNOTATED
                 ], stdin=file, stdout=subprocess.PIPE)
 
-        with open(contacts_file, 'w') as fh:
             pipe2 = subprocess.Popen([
                 PROGRAM_PATH,
                 COMMAND_CONTACTS,
@@ -47,74 +118,225 @@ def create_contacts_file(file_name):
                 COMMAND_CONTACTS_STEP,
                 COMMAND_CONTACTS_STEP_VAL
                 ], stdin=pipe.stdout, stdout=fh)
-            pipe2.wait()
-            
+            pipe.stdout.close()
+            Tracing.wait(pipe2)
+            Tracing.wait(pipe)
+
+        if pipe.returncode != 0 or pipe2.returncode != 0:
+            raise RuntimeError("voronota exited with {} {}".format(
+                pipe.returncode, pipe2.returncode))
+
+        os.replace(tmp_file, contacts_file)
     except Exception as e:
         logging.error("Creating contacts: {}".format(e))
+        Workspace.delete_file(tmp_file)
         return False
 
     logging.debug("Contacts file in {} has been created".format(path))
+    Workspace.record_usage(file_name, cost=time.time() - started)
     # return (True, None)ALPHA
     return True
 
-def draw(file_name, query, ID, params):
+def drawing_name(ID):
+    """Name of CGO object created by the drawing"""
+    return 'vcontacts_' + str(ID)
+
+def draw(file_name, query, ID, params, draw_file=None):
     path = Workspace.mkdir(file_name)
     contacts_file = Workspace.construct_file_path(path, 'contacts')
 
-    draw_file = Workspace.construct_file_path(path, 'draw' + str(ID))
+    if draw_file is None:
+        draw_file = Workspace.construct_file_path(path, 'draw' + str(ID))
 
     query = query.split(' ')
     filters = list(params['query'].keys())
     drawing = list()
     [drawing.extend([str(k),str(v)]) for k,v in params['drawing'].items()]
-    
-    # try:
-    file = open(contacts_file)
-
-    pipe = subprocess.Popen([
-        PROGRAM_PATH,
-        COMMAND_QUERY_CONTACTS,
-        COMMAND_QUERY_CONTACTS_GRAPHICS,
-        ]+query+filters, stdin=file, stdout=subprocess.PIPE) #stdout=subprocess.PIPE)
-
-    devnull = open(os.devnull, 'w')
-
-    pipe2 = subprocess.Popen([
-        PROGRAM_PATH,
-        COMMAND_DRAW,
-        '--drawing-name',
-        'vcontacts_' + str(ID),
-        COMMAND_DRAW_PYMOL,
-        draw_file,
-        ]+drawing, stdout=devnull, stdin=pipe.stdout)
-    pipe2.wait()
-    
+
+    try:
+        with open(contacts_file) as file, open(os.devnull, 'w') as devnull, \
+                _job(os.path.getsize(contacts_file), 'drawing'):
+            pipe = subprocess.Popen([
+                PROGRAM_PATH,
+                COMMAND_QUERY_CONTACTS,
+                COMMAND_QUERY_CONTACTS_GRAPHICS,
+                ]+query+filters, stdin=file, stdout=subprocess.PIPE)
+
+            pipe2 = subprocess.Popen([
+                PROGRAM_PATH,
+                COMMAND_DRAW,
+                '--drawing-name',
+                drawing_name(ID),
+                COMMAND_DRAW_PYMOL,
+                draw_file,
+                ]+drawing, stdout=devnull, stdin=subprocess.PIPE)
+            # copied here to know if anything was selected, draw-contacts
+            # fails on empty input
+            size = 0
+            try:
+                for block in iter(lambda: pipe.stdout.read(ContactIndex.BLOCK_SIZE), b''):
+                    pipe2.stdin.write(block)
+                    size += len(block)
+            finally:
+                pipe2.stdin.close()
+                pipe.stdout.close()
+                Tracing.wait(pipe2)
+                Tracing.wait(pipe)
+        _check_returncodes(pipe, pipe2 if size else None)
+    except (RuntimeError, IOError, OSError) as e:
+        logging.error("Drawing contacts: {}".format(e))
+        return False
+
     return True
 
+def _check_returncodes(*pipes):
+    """Raises RuntimeError if any of finished voronota processes failed,
+    None pipes are skipped"""
+    codes = [pipe.returncode for pipe in pipes if pipe is not None]
+    if any(codes):
+        raise RuntimeError("voronota exited with {}".format(
+            ' '.join(str(code) for code in codes)))
+
 def summarize(file_name, query):
     path = Workspace.mkdir(file_name)
     contacts_file = Workspace.construct_file_path(path, 'contacts')
     query = query.split(' ')
-    try:
-        file = open(contacts_file)
-
-        pipe = subprocess.Popen([
-            PROGRAM_PATH,
-            COMMAND_QUERY_CONTACTS,
-            '--summarize-by-first'
-            ]+query, stdin=file,stdout=subprocess.PIPE) #stdout=subprocess.PIPE)
 
+    try:
+        with open(contacts_file) as file, \
+                _job(os.path.getsize(contacts_file), 'query'):
+            pipe = subprocess.Popen([
+                PROGRAM_PATH,
+                COMMAND_QUERY_CONTACTS,
+                '--summarize-by-first'
+                ]+query, stdin=file,stdout=subprocess.PIPE)
 
-        summary = defaultdict(int)
-        for line in iter(pipe.stdout.readline, ''):
-            line = line.decode().strip()
-            if not line:
-                break
-            data = line.split(" ")
-            m = re.search('c<(.*?)>', data[0])
-            summary[m.group(1)] +=  float(data[2])
+            summary = summarize_stream(pipe.stdout)
+            pipe.stdout.close()
+            Tracing.wait(pipe)
+        _check_returncodes(pipe)
 
     except Exception as e:
         logging.error(e)
         return False
     return summary
+
+def summarize_stream(stream):
+    """Contact area by chain of query-contacts --summarize-by-first output"""
+    summary = defaultdict(int)
+    for lines in ContactIndex.read_blocks(stream):
+        for line in lines:
+            data = line.split(b' ', 3)
+            if len(data) < 3:
+                continue
+            first = data[0]
+            if first.startswith(b'c<'):
+                # chain leads voronota descriptors, skip parsing the rest
+                chain = first[2:first.index(b'>')].decode()
+            else:
+                chain = ContactIndex.parse_descriptor(first.decode()).get('c')
+            summary[chain] += float(data[2])
+    return summary
+
+def query(file_name, query, ID, params, draw_file=None):
+    """Draws and summarizes contacts in one pass: contacts selected by
+    query and params filters go both to draw-contacts and to the per chain
+    area summary. Returns (summary, details) or None if voronota failed,
+    details are None when the query is left to voronota"""
+    path = Workspace.mkdir(file_name)
+    contacts_file = Workspace.construct_file_path(path, 'contacts')
+
+    if draw_file is None:
+        draw_file = Workspace.construct_file_path(path, 'draw' + str(ID))
+
+    args = query.split(' ') + list(params['query'].keys())
+    try:
+        parsed = ContactIndex.parse_query(args)
+    except ValueError as e:
+        logging.debug("Query is drawn and summarized separately: {}".format(e))
+        if not draw(file_name, query, ID, params, draw_file):
+            return None
+        summary = summarize(file_name, query)
+        return None if summary is False else (summary, None)
+
+    drawing = list()
+    [drawing.extend([str(k),str(v)]) for k,v in params['drawing'].items()]
+
+    lines = None
+    if ContactIndex.enabled():
+        with Metrics.timed('query'), Tracing.span('query'):
+            lines, summary, details = ContactIndex.get(contacts_file).query(parsed)
+        cost = len(lines)
+    else:
+        cost = os.path.getsize(contacts_file)
+
+    if lines == b'':
+        # nothing selected, draw-contacts would fail on empty input
+        return summary, details
+
+    try:
+        with open(os.devnull, 'w') as devnull, _job(cost, 'drawing'):
+            pipe = subprocess.Popen([
+                PROGRAM_PATH,
+                COMMAND_DRAW,
+                '--drawing-name',
+                drawing_name(ID),
+                COMMAND_DRAW_PYMOL,
+                draw_file,
+                ]+drawing, stdout=devnull, stdin=subprocess.PIPE)
+            try:
+                if lines is not None:
+                    pipe.stdin.write(lines)
+                    size = len(lines)
+                else:
+                    summary, details, size = _tee_query(
+                        contacts_file, args, parsed, pipe.stdin)
+            finally:
+                pipe.stdin.close()
+                Tracing.wait(pipe)
+        if size:
+            _check_returncodes(pipe)
+    except (RuntimeError, IOError, OSError) as e:
+        logging.error("Querying contacts: {}".format(e))
+        return None
+
+    return summary, details
+
+def residue_matrix(file_name, query, params):
+    """Sparse residue by residue contact area and minimal distance of
+    contacts selected by query, see ContactIndex.residue_matrix.
+    None if numpy is missing or the query is left to voronota"""
+    if ContactIndex.np is None:
+        return None
+    path = Workspace.mkdir(file_name)
+    contacts_file = Workspace.construct_file_path(path, 'contacts')
+    try:
+        parsed = ContactIndex.parse_query(
+            query.split(' ') + list(params['query'].keys()))
+    except ValueError:
+        return None
+    return ContactIndex.get(contacts_file).residue_matrix(parsed)
+
+def _tee_query(contacts_file, args, parsed, output):
+    """Runs query-contacts once, copies selected contacts to output
+    and summarizes them. Returns (summary, details, bytes copied),
+    raises RuntimeError if query-contacts failed"""
+    summary = ContactIndex.Summary(parsed)
+    size = 0
+    with open(contacts_file) as file, Metrics.timed('query'), \
+            Tracing.span('query'):
+        pipe = subprocess.Popen([
+            PROGRAM_PATH,
+            COMMAND_QUERY_CONTACTS,
+            COMMAND_QUERY_CONTACTS_GRAPHICS,
+            ]+args, stdin=file, stdout=subprocess.PIPE)
+        try:
+            for block in iter(lambda: pipe.stdout.read(ContactIndex.BLOCK_SIZE), b''):
+                output.write(block)
+                summary.feed(block)
+                size += len(block)
+        finally:
+            pipe.stdout.close()
+            Tracing.wait(pipe)
+    _check_returncodes(pipe)
+    return summary.result() + (size,)
@@ -1,15 +1,66 @@
 # -*- coding: utf-8 -*-
 
 import os
+import re
 import sys
+import json
 import time
 import shutil
 import hashlib
 import logging
+import tempfile
+import threading
+import contextlib
+
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows, index files are only safe within a process
+    fcntl = None
 
 from .Config import *
 
 
+ALIASES_FILE = 'aliases.json'
+CHECKSUMS_FILE = 'checksums.json'
+# digest -> seconds it took to calculate contacts of the structure
+COSTS_FILE = 'costs.json'
+UPLOAD_PREFIX = '.upload-'
+# Locked by processes updating the json index files
+JSON_LOCK_FILE = '.json.lock'
+# Content addressed pieces of uploaded structures
+CHUNKS_DIR = '.chunks'
+# Cached query results, size is kept within limits by ResultCache
+RESULTS_DIR = '.results'
+
+_digest_re = re.compile(r'^[0-9a-f]{64}\Z')
+
+# model name -> content digest
+_aliases = None
+_aliases_lock = threading.Lock()
+
+# digest -> size and mtime of the stored structure when it was last hashed
+_checksums = None
+_checksums_lock = threading.Lock()
+
+# Disk quota mode (DISK_QUOTA > 0)
+# digest -> [priority, last use, size, cost], None until workspace is scanned
+_usage = None
+_usage_size = 0
+# priority of the last evicted structure, added to priorities of used ones
+_usage_base = 0.0
+# digest -> number of requests using the structure
+_pins = dict()
+# structures being removed, they are out of the usage index already
+_evicting = set()
+_usage_lock = threading.Lock()
+# notified when removal of evicted structures is finished
+_evicted = threading.Condition(_usage_lock)
+
+# (bytes, time measured) of the whole workspace
+_disk_usage = (0, None)
+
+
 def mkdir_root():
     """Creates servers root dir if not exists"""
     if not os.path.exists(SERVER_DIR):
@@ -39,25 +90,236 @@ def file_exists(file_name, file_size=None, file_path_FLAG=False):
     return False
 
 
-def file_check_checksum(file_name, checksum):
-    dirPath = os.path.join(SERVER_DIR, file_name)
+def is_digest(value):
+    """Checks if value looks like a SHA-256 hex digest"""
+    return bool(_digest_re.match(value))
 
-    if not os.path.isdir(dirPath):
-        return False
 
-    filePath = os.path.join(dirPath, file_name)
+def structure_file(digest):
+    """Returns path of the stored structure with the given digest"""
+    return os.path.join(SERVER_DIR, digest, digest)
 
-    if not os.path.isfile(filePath):
+
+def has_structure(digest):
+    """Checks if structure with the given digest is stored"""
+    return is_digest(digest) and os.path.isfile(structure_file(digest))
+
+
+def file_check_checksum(checksum):
+    """Checks if structure with the given checksum is stored and intact.
+    The file is rehashed only if its size or mtime differ from the index"""
+    if not has_structure(checksum):
         return False
 
+    file_path = structure_file(checksum)
+    stat = os.stat(file_path)
+    with _checksums_lock:
+        entry = _load_checksums().get(checksum)
+    if entry and entry == [stat.st_size, stat.st_mtime]:
+        record_usage(checksum)
+        return True
+
     sha = hashlib.sha256()
-    with open(filePath, 'rb') as fh:
+    with open(file_path, 'rb') as fh:
         for chunk in iter(lambda: fh.read(4096), "".encode()):
             sha.update(chunk)
 
     logging.debug("CHECKSUM: {} : {}".format(checksum, sha.hexdigest()))
 
-    return checksum == sha.hexdigest()
+    if checksum != sha.hexdigest():
+        return False
+    record_checksum(checksum)
+    record_usage(checksum)
+    return True
+
+
+def record_checksum(digest):
+    """Records size and mtime of the stored structure in the checksum index"""
+    stat = os.stat(structure_file(digest))
+    with _checksums_lock:
+        _update_json(CHECKSUMS_FILE,
+                     lambda data: data.update({digest: [stat.st_size, stat.st_mtime]}),
+                     _load_checksums())
+
+
+class Upload(object):
+    """Structure file written incrementally and stored under its SHA-256
+    digest on commit"""
+    def __init__(self):
+        mkdir_root()
+        fd, self._tmp_path = tempfile.mkstemp(prefix=UPLOAD_PREFIX, dir=SERVER_DIR)
+        self._fh = os.fdopen(fd, 'wb')
+        self._sha = hashlib.sha256()
+
+    def write(self, chunk):
+        self._sha.update(chunk)
+        self._fh.write(chunk)
+
+    def abort(self):
+        self._fh.close()
+        delete_file(self._tmp_path)
+
+    def commit(self, name=None):
+        """Moves file into place and returns its digest"""
+        self._fh.close()
+        digest = self._sha.hexdigest()
+        # don't store it into a directory being removed
+        wait_evicted(digest)
+        if has_structure(digest):
+            # identical content is already stored
+            delete_file(self._tmp_path)
+        else:
+            os.replace(self._tmp_path, construct_file_path(mkdir(digest), digest))
+            record_checksum(digest)
+            logging.debug("Stored structure {}".format(digest))
+        record_usage(digest)
+
+        if name:
+            set_alias(name, digest)
+        return digest
+
+
+def store_file(chunks, name=None):
+    """Stores file content under its SHA-256 digest and returns the digest.
+    chunks is an iterable of bytes"""
+    upload = Upload()
+    try:
+        for chunk in chunks:
+            upload.write(chunk)
+    except Exception:
+        upload.abort()
+        raise
+    return upload.commit(name)
+
+
+def chunk_file(digest):
+    """Returns path of the stored chunk with the given digest"""
+    return os.path.join(SERVER_DIR, CHUNKS_DIR, digest)
+
+
+def missing_chunks(digests):
+    """Returns indices of chunks which are not stored"""
+    return [i for i, digest in enumerate(digests)
+            if not (is_digest(digest) and os.path.isfile(chunk_file(digest)))]
+
+
+def store_chunk(data):
+    """Stores chunk under its SHA-256 digest and returns the digest"""
+    digest = hashlib.sha256(data).hexdigest()
+    if not os.path.isfile(chunk_file(digest)):
+        fd, tmp_path = tempfile.mkstemp(prefix=UPLOAD_PREFIX, dir=mkdir(CHUNKS_DIR))
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(data)
+        os.replace(tmp_path, chunk_file(digest))
+    return digest
+
+
+def assemble_chunks(digests, name=None):
+    """Stores structure made of stored chunks and returns its digest"""
+    def read_chunks():
+        for digest in digests:
+            file_path = chunk_file(digest)
+            with open(file_path, 'rb') as fh:
+                yield fh.read()
+            # keep chunks of structures in use from cleanup
+            os.utime(file_path, None)
+    return store_file(read_chunks(), name)
+
+
+def _load_json(file_name):
+    """Reads json file from servers root dir, returns empty dict if missing"""
+    file_path = os.path.join(SERVER_DIR, file_name)
+    if os.path.isfile(file_path):
+        try:
+            with open(file_path) as fh:
+                return json.load(fh)
+        except ValueError as e:
+            logging.error("Can't load {}: {}".format(file_name, e))
+    return dict()
+
+
+def _load_aliases(reload=False):
+    global _aliases
+    if _aliases is None or reload:
+        _aliases = _load_json(ALIASES_FILE)
+    return _aliases
+
+
+def _load_costs():
+    return _load_json(COSTS_FILE)
+
+
+def _load_checksums():
+    global _checksums
+    if _checksums is None:
+        _checksums = _load_json(CHECKSUMS_FILE)
+    return _checksums
+
+
+def _dump_json(file_name, data):
+    """Atomically writes data as json to servers root dir"""
+    mkdir_root()
+    fd, tmp_path = tempfile.mkstemp(prefix=UPLOAD_PREFIX, dir=SERVER_DIR)
+    with os.fdopen(fd, 'w') as fh:
+        json.dump(data, fh)
+    os.replace(tmp_path, os.path.join(SERVER_DIR, file_name))
+
+
+@contextlib.contextmanager
+def _json_file_lock():
+    """Serializes json index updates of processes sharing the workspace"""
+    if fcntl is None:
+        yield
+        return
+    mkdir_root()
+    with open(os.path.join(SERVER_DIR, JSON_LOCK_FILE), 'a') as fh:
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+
+def _update_json(file_name, change, cache=None):
+    """Applies change to the content of json file and writes it back,
+    unless change returns False. The file is reread under a file lock, so
+    entries written meanwhile by another process (server or precompute.py)
+    are kept. cache is refreshed with the content.
+    Must be called with the lock of cache held"""
+    with _json_file_lock():
+        data = _load_json(file_name)
+        if change(data) is not False:
+            _dump_json(file_name, data)
+    if cache is not None:
+        cache.clear()
+        cache.update(data)
+
+
+def set_alias(name, digest):
+    """Points model name to structure digest"""
+    with _aliases_lock:
+        aliases = _load_aliases()
+        if aliases.get(name) == digest:
+            return
+        _update_json(ALIASES_FILE, lambda data: data.update({name: digest}),
+                     aliases)
+
+
+def resolve(name, session_aliases=None):
+    """Returns digest of the stored structure for a digest or model name.
+    Aliases of the client session take precedence over the global ones"""
+    if session_aliases and name in session_aliases:
+        return session_aliases[name]
+    if has_structure(name):
+        return name
+    with _aliases_lock:
+        digest = _load_aliases().get(name)
+        if digest is None:
+            # may have been named by another process meanwhile
+            digest = _load_aliases(reload=True).get(name)
+    if digest and has_structure(digest):
+        return digest
+    return None
 
 
 def mkdir(dir_name):
@@ -66,7 +328,12 @@ def mkdir(dir_name):
     dirPath = os.path.join(SERVER_DIR, dir_name)
     if not os.path.isdir(dirPath):
         logging.debug("Creating directory: {}".format(dir_name))
-        os.mkdir(dirPath)
+        try:
+            os.mkdir(dirPath)
+        except OSError:
+            # created by another client in the meantime
+            if not os.path.isdir(dirPath):
+                raise
     return dirPath
 
 
@@ -80,6 +347,164 @@ def construct_file_path(destination, file_name):
     return os.path.join(destination, file_name)
 
 
+def _directory_size(directory):
+    size = 0
+    for file_name in os.listdir(directory):
+        try:
+            size += os.path.getsize(os.path.join(directory, file_name))
+        except OSError:
+            pass
+    return size
+
+
+def disk_usage(max_age=60):
+    """Size of the workspace in bytes, measured at most every max_age
+    seconds"""
+    global _disk_usage
+
+    size, measured = _disk_usage
+    if measured is None or time.time() - measured > max_age:
+        size = 0
+        for root, _, files in os.walk(SERVER_DIR):
+            for file_name in files:
+                try:
+                    size += os.path.getsize(os.path.join(root, file_name))
+                except OSError:
+                    pass
+        _disk_usage = (size, time.time())
+    return size
+
+
+def _priority(size, cost):
+    """GreedyDual-Size priority: structures expensive to recompute per
+    megabyte of disk stay longer, recently used ones get current base"""
+    return _usage_base + cost / max(size / float(1 << 20), 1e-3)
+
+
+def _load_usage():
+    """Scans workspace on first use in quota mode.
+    Must be called with _usage_lock held"""
+    global _usage, _usage_size
+
+    if _usage is None:
+        _usage = dict()
+        _usage_size = 0
+        costs = _load_costs()
+        if os.path.isdir(SERVER_DIR):
+            for digest in os.listdir(SERVER_DIR):
+                if not has_structure(digest):
+                    continue
+                directory = os.path.join(SERVER_DIR, digest)
+                size = _directory_size(directory)
+                cost = 1.0 + costs.get(digest, 0.0)
+                _usage[digest] = [_priority(size, cost),
+                                  os.stat(directory).st_mtime, size, cost]
+                _usage_size += size
+    return _usage
+
+
+def record_cost(digest, cost):
+    """Stores time in seconds it took to calculate contacts of structure,
+    used by quota eviction. Recorded even if quota is off in this process"""
+    with _checksums_lock:
+        _update_json(COSTS_FILE, lambda data: data.update({digest: cost}))
+
+
+def record_usage(digest, cost=None):
+    """Marks structure as used now and updates its size in the usage index.
+    cost is time in seconds it took to calculate its contacts.
+    Structures are evicted right away if workspace grows over DISK_QUOTA"""
+    global _usage_size
+
+    if DISK_QUOTA <= 0:
+        return
+
+    if cost is not None:
+        record_cost(digest, cost)
+
+    directory = os.path.join(SERVER_DIR, digest)
+    if not os.path.isdir(directory):
+        return
+    size = _directory_size(directory)
+
+    with _usage_lock:
+        if digest in _evicting:
+            return
+        usage = _load_usage()
+        entry = usage.get(digest)
+        if entry is None:
+            entry = usage[digest] = [0.0, 0.0, 0, 1.0]
+        if cost is not None:
+            entry[3] = 1.0 + cost
+        _usage_size += size - entry[2]
+        entry[2] = size
+        entry[1] = time.time()
+        entry[0] = _priority(size, entry[3])
+
+        if _usage_size <= DISK_QUOTA:
+            return
+        victims = _evict(digest)
+
+    # directories are removed without holding the lock, requests wait in
+    # in_use only if they need one of them
+    for victim in victims:
+        logging.info("Disk quota exceeded, removing structure {}".format(victim))
+        shutil.rmtree(os.path.join(SERVER_DIR, victim), ignore_errors=True)
+    with _usage_lock:
+        _evicting.difference_update(victims)
+        _evicted.notify_all()
+
+
+def _evict(keep):
+    """Picks structures with the lowest priority to remove until workspace
+    fits DISK_QUOTA, drops them from the usage index and marks them as
+    evicting. keep and structures used by requests in progress stay.
+    Returns digests of picked structures, the caller removes them.
+    Must be called with _usage_lock held"""
+    global _usage_size, _usage_base
+
+    candidates = sorted(
+        (entry[0], entry[1], digest) for digest, entry in _usage.items()
+        if digest != keep and not _pins.get(digest))
+    victims = list()
+    for priority, _, digest in candidates:
+        if _usage_size <= DISK_QUOTA:
+            break
+        _usage_base = priority
+        _usage_size -= _usage.pop(digest)[2]
+        _evicting.add(digest)
+        victims.append(digest)
+
+    if _usage_size > DISK_QUOTA:
+        logging.warning("Disk quota exceeded by structures in use: {} bytes"
+            .format(_usage_size))
+    return victims
+
+
+def wait_evicted(digest):
+    """Waits until structure picked for eviction is removed"""
+    with _usage_lock:
+        while digest in _evicting:
+            _evicted.wait()
+
+
+@contextlib.contextmanager
+def in_use(digest):
+    """Keeps structure from quota eviction while the block runs.
+    Structure which is being removed is waited for, it is gone then"""
+    with _usage_lock:
+        while digest in _evicting:
+            _evicted.wait()
+        _pins[digest] = _pins.get(digest, 0) + 1
+    try:
+        yield
+    finally:
+        with _usage_lock:
+            _pins[digest] -= 1
+            if not _pins[digest]:
+                del _pins[digest]
+
+
 def cleanup():
     """Clean up function for removing old directories and content within"""
     logging.debug("Starting clean up")
@@ -87,10 +512,40 @@ def cleanup():
         return
     for dir in os.listdir(SERVER_DIR):
         directory = os.path.join(SERVER_DIR, dir)
+        if dir == CHUNKS_DIR:
+            for chunk in os.listdir(directory):
+                chunk_path = os.path.join(directory, chunk)
+                if time.time() - os.stat(chunk_path).st_mtime > OLDER_THAN:
+                    delete_file(chunk_path)
+            continue
+        if dir == RESULTS_DIR:
+            continue
+        if DISK_QUOTA > 0 and has_structure(dir):
+            # structures are evicted by record_usage in quota mode
+            continue
         if time.time() - os.stat(directory).st_mtime > OLDER_THAN:
             if os.path.isdir(directory):
                 logging.debug("Removing directory {}".format(directory))
                 shutil.rmtree(directory, ignore_errors=True)
+            elif dir.startswith(UPLOAD_PREFIX):
+                # leftover of an interrupted upload
+                delete_file(directory)
+
+    def remove_stale(data, digest_of=lambda key, value: key):
+        stale = [key for key, value in data.items()
+                 if not has_structure(digest_of(key, value))]
+        for key in stale:
+            del data[key]
+        return bool(stale)
+
+    with _aliases_lock:
+        _update_json(ALIASES_FILE,
+                     lambda data: remove_stale(data, lambda name, digest: digest),
+                     _load_aliases())
+
+    with _checksums_lock:
+        _update_json(CHECKSUMS_FILE, remove_stale, _load_checksums())
+        _update_json(COSTS_FILE, remove_stale)
 
 def delete_file(file_path):
     if os.path.exists(file_path):
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Stores structures in the workspace and calculates their contacts ahead
+of time, so the first query from PyMOL does not wait for voronota.
+
+    precompute.py DIRECTORY [DIRECTORY ...]
+    precompute.py --manifest FILE
+
+Structures are stored under their content digest like uploads are, and
+named after the file (1abc.pdb -> 1abc). PyMOL checks structures by the
+digest of the PDB it writes itself, so files should be saved from PyMOL
+(save 1abc.pdb) to be found by Vcontacts.
+
+Structures which already have contacts are skipped, so an interrupted
+run continues where it stopped when it is started again.
+
+Nothing is evicted over DISK_QUOTA: this process can't see structures a
+running server is using, so the quota is left to the server, which
+enforces it the next time a structure is used. Calculation times are
+recorded, so the server keeps the expensive structures longest."""
+
+import os
+import sys
+import time
+import logging
+import argparse
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+srv_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(srv_path, 'lib'))
+
+from lib import Config
+from lib import Workspace
+from lib import Voronota
+
+
+EXTENSIONS = ('.pdb', '.ent')
+
+
+def find_structures(directories, manifest=None):
+    """Returns paths of structure files in directories and manifest"""
+    paths = list()
+    for directory in directories:
+        for root, _, files in os.walk(directory):
+            for file_name in sorted(files):
+                if file_name.lower().endswith(EXTENSIONS):
+                    paths.append(os.path.join(root, file_name))
+
+    if manifest:
+        # one path per line, relative to the manifest
+        base = os.path.dirname(os.path.abspath(manifest))
+        with open(manifest) as fh:
+            for line in fh:
+                line = line.split('#')[0].strip()
+                if line:
+                    paths.append(os.path.join(base, line))
+    return paths
+
+
+def store(path):
+    """Stores structure file, returns its digest"""
+    def read_chunks():
+        with open(path, 'rb') as fh:
+            for chunk in iter(lambda: fh.read(65536), b''):
+                yield chunk
+    name = os.path.splitext(os.path.basename(path))[0].lower()
+    return Workspace.store_file(read_chunks(), name)
+
+
+def has_contacts(digest):
+    contacts_file = Workspace.construct_file_path(
+        os.path.join(Config.SERVER_DIR, digest), 'contacts')
+    return os.path.isfile(contacts_file)
+
+
+def disable_quota():
+    # usage index of this process does not know structures in use by a
+    # running server or by other workers, quota is enforced by the server
+    Workspace.DISK_QUOTA = 0
+
+
+def calculate(digest):
+    """Runs in worker process, returns (success, seconds)"""
+    started = time.time()
+    return Voronota.create_contacts_file(digest), time.time() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Precompute contacts of structures for Vcontacts server")
+    parser.add_argument('directories', nargs='*', metavar='DIRECTORY',
+        help="directories searched for *.pdb and *.ent files")
+    parser.add_argument('--manifest', help="file listing structure paths")
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(),
+        help="number of voronota processes (default: number of cores)")
+    parser.add_argument('--debug', action='store_true')
+    args = parser.parse_args()
+
+    if not args.directories and not args.manifest:
+        parser.error("no directories or manifest given")
+
+    logging.basicConfig(
+        filename=Config.LOGGER_FILE,
+        format=Config.LOGGER_FORMATTER,
+        level=logging.DEBUG if args.debug else logging.INFO)
+
+    disable_quota()
+    Workspace.mkdir_root()
+    paths = find_structures(args.directories, args.manifest)
+    total = len(paths)
+    started = time.time()
+    counts = {'done': 0, 'skipped': 0, 'failed': 0}
+
+    def report(path, status, seconds=None):
+        counts[status] += 1
+        finished = sum(counts.values())
+        print("[{:{w}}/{}] {:7} {}{}".format(
+            finished, total, status, path,
+            " ({:.1f}s)".format(seconds) if seconds is not None else '',
+            w=len(str(total))))
+        sys.stdout.flush()
+
+    with ProcessPoolExecutor(max_workers=args.jobs, initializer=disable_quota) as pool:
+        futures = dict()
+        submitted = set()
+        for path in paths:
+            try:
+                digest = store(path)
+            except (IOError, OSError) as e:
+                logging.error("Storing {}: {}".format(path, e))
+                report(path, 'failed')
+                continue
+            if has_contacts(digest) or digest in submitted:
+                report(path, 'skipped')
+                continue
+            submitted.add(digest)
+            futures[pool.submit(calculate, digest)] = (path, digest)
+
+        for future in as_completed(futures):
+            path, digest = futures[future]
+            try:
+                success, seconds = future.result()
+            except Exception as e:
+                logging.error("Calculating contacts of {}: {}".format(path, e))
+                success, seconds = False, None
+            if success:
+                # workers don't record it, quota is off in them
+                Workspace.record_cost(digest, seconds)
+            report(path, 'done' if success else 'failed', seconds)
+
+    print("{} done, {} skipped, {} failed in {:.1f}s".format(
+        counts['done'], counts['skipped'], counts['failed'],
+        time.time() - started))
+    return 1 if counts['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
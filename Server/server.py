@@ -18,6 +18,9 @@ from lib import Config
 from lib import Workspace
 from lib import TCPServer
 from lib import RepeatJob
+from lib import Metrics
+from lib import Operations
+from lib import Tracing
 
 
 __author__  = "Rimvydas Noreika"
@@ -46,8 +49,25 @@ def main():
     rj = RepeatJob.RepeatJob(Config.CHECK_FOR_OLD_FILES, Workspace.cleanup)
     rj.start()
 
+    if Config.METRICS_PORT:
+        Metrics.serve(Config.METRICS_PORT, Operations.server_stats)
+
+    # --profile[=N] saves cProfile stats of every N-th request (default 10)
+    for arg in sys.argv[1:]:
+        if arg == '--profile' or arg.startswith('--profile='):
+            Tracing.enable_profiling(os.path.join(srv_path, 'profiles'),
+                                     arg.partition('=')[2] or 10)
+
+    if Config.ENGINE == 'asyncio':
+        run_asyncio()
+        rj.stop()
+        return
+
     try:
-        server = TCPServer.TCPServer(Config.HOST, Config.PORT)
+        server = TCPServer.TCPServer(
+            Config.HOST, Config.PORT,
+            Config.WORKERS, Config.QUEUE_SIZE, Config.LISTEN_BACKLOG,
+            Config.IDLE_TIMEOUT)
         server.start()
     except Exception as e:
         logging.critical("Can't start the server")
@@ -63,5 +83,22 @@ def main():
         del server
         rj.stop()
 
+def run_asyncio():
+    from lib import AsyncServer
+
+    try:
+        server = AsyncServer.AsyncServer(
+            Config.HOST, Config.PORT, Config.MAX_JOBS, Config.LISTEN_BACKLOG,
+            Config.IDLE_TIMEOUT)
+    except Exception as e:
+        logging.critical("Can't start the server")
+        return
+
+    try:
+        print("Server is running. Press Ctrl+C to stop")
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logging.debug("Keyboard interrupt")
+
 if __name__ == '__main__':
     main()
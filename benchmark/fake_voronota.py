@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Stand-in for the voronota executable used by the load benchmark.
+
+Implements the commands the server runs with output in voronota's
+formats, so the whole server (contacts index, drawing, caches) works on
+it. Contacts are made between every atom and its next neighbours in the
+file plus solvent, selections of query-contacts are ignored.
+
+Tuned by environment variables:
+    FAKE_VORONOTA_CONTACTS_DELAY  seconds calculate-contacts sleeps (1.0)
+    FAKE_VORONOTA_DELAY           seconds other commands sleep (0.05)
+    FAKE_VORONOTA_NEIGHBOURS      contacts of each atom (8)
+    FAKE_VORONOTA_VERTICES        vertices drawn of each contact (12)"""
+
+import os
+import sys
+import math
+import time
+
+
+CONTACTS_DELAY = float(os.environ.get('FAKE_VORONOTA_CONTACTS_DELAY', 1.0))
+DELAY = float(os.environ.get('FAKE_VORONOTA_DELAY', 0.05))
+NEIGHBOURS = int(os.environ.get('FAKE_VORONOTA_NEIGHBOURS', 8))
+VERTICES = int(os.environ.get('FAKE_VORONOTA_VERTICES', 12))
+
+SOLVENT = 'c<solvent>'
+
+
+def option(args, name, default=None):
+    if name in args:
+        return args[args.index(name) + 1]
+    return default
+
+
+def get_balls(args):
+    """PDB atoms to 'descriptor x y z' lines"""
+    for line in sys.stdin:
+        if not line.startswith(('ATOM', 'HETATM')):
+            continue
+        descriptor = 'c<{}>r<{}>a<{}>R<{}>A<{}>'.format(
+            line[21].strip() or '?', line[22:26].strip(), line[6:11].strip(),
+            line[17:20].strip(), line[12:16].strip())
+        sys.stdout.write('{} {} {} {}\n'.format(
+            descriptor, line[30:38].strip(), line[38:46].strip(), line[46:54].strip()))
+
+
+def fan(center, radius, seed):
+    """Graphics of a contact: triangle fan around center"""
+    normal = (math.sin(seed), math.cos(seed), 0.0)
+    values = ['_tfanc'] + ['{:.3f}'.format(v) for v in center + normal] + [str(VERTICES)]
+    for i in range(VERTICES):
+        angle = 2 * math.pi * i / VERTICES
+        values += ['{:.3f}'.format(v) for v in (
+            center[0] + radius * math.cos(angle) * normal[1],
+            center[1] - radius * math.cos(angle) * normal[0],
+            center[2] + radius * math.sin(angle))]
+    return '"' + ' '.join(values) + '"'
+
+
+def calculate_contacts(args):
+    time.sleep(CONTACTS_DELAY)
+    atoms = list()
+    for line in sys.stdin:
+        fields = line.split()
+        if len(fields) == 4:
+            atoms.append((fields[0], tuple(float(v) for v in fields[1:])))
+
+    draw = '--draw' in args
+    out = sys.stdout
+    for i, (a, xyz_a) in enumerate(atoms):
+        for j in range(i + 1, min(i + 1 + NEIGHBOURS, len(atoms))):
+            b, xyz_b = atoms[j]
+            dist = math.sqrt(sum((p - q) ** 2 for p, q in zip(xyz_a, xyz_b)))
+            area = 0.5 + (i * 7 + j * 13) % 200 / 10.0
+            line = '{} {} {:.6g} {:.6g} . .'.format(a, b, area, dist)
+            if draw:
+                center = tuple((p + q) / 2 for p, q in zip(xyz_a, xyz_b))
+                line += ' ' + fan(center, math.sqrt(area / math.pi), i + j)
+            out.write(line + '\n')
+        line = '{} {} {:.6g} {:.6g} . .'.format(a, SOLVENT, 5.0 + i % 30, 3.0)
+        if draw:
+            line += ' ' + fan(xyz_a, 1.0, i)
+        out.write(line + '\n')
+
+
+def query_contacts(args):
+    time.sleep(DELAY)
+    if '--summarize-by-first' in args:
+        totals = dict()
+        for line in sys.stdin:
+            fields = line.split(' ', 4)
+            if len(fields) >= 4:
+                total = totals.setdefault(fields[0], [0.0, float(fields[3])])
+                total[0] += float(fields[2])
+        for descriptor, (area, dist) in totals.items():
+            sys.stdout.write('{} c<any> {:.6g} {:.6g} . .\n'.format(descriptor, area, dist))
+        return
+
+    graphics = '--preserve-graphics' in args
+    for line in sys.stdin:
+        if not graphics:
+            line = ' '.join(line.split(' ', 6)[:6]).rstrip('\n') + '\n'
+        sys.stdout.write(line)
+
+
+def draw_contacts(args):
+    time.sleep(DELAY)
+    name = option(args, '--drawing-name', 'contacts')
+    color = option(args, '--default-color', '0xFFFFFF')
+    alpha = float(option(args, '--alpha', 1.0))
+    rgb = int(color.replace('0x', ''), 16)
+
+    parts = ['{} = [COLOR, {:.3f}, {:.3f}, {:.3f},\n'.format(
+        name, (rgb >> 16 & 255) / 255.0, (rgb >> 8 & 255) / 255.0, (rgb & 255) / 255.0)]
+    parts.append('ALPHA, {:.3f},\n'.format(alpha))
+    empty = True
+    for line in sys.stdin:
+        start = line.find('"_tfanc ')
+        if start < 0:
+            continue
+        empty = False
+        values = line[start + 8:].rstrip().rstrip('"').split()
+        normal = ', '.join(values[3:6])
+        parts.append('BEGIN, TRIANGLE_FAN,\nNORMAL, {},\nVERTEX, {},\n'.format(
+            normal, ', '.join(values[0:3])))
+        for i in range(int(values[6])):
+            parts.append('NORMAL, {},\nVERTEX, {},\n'.format(
+                normal, ', '.join(values[7 + 3 * i:10 + 3 * i])))
+        parts.append('END,\n')
+    if empty:
+        # voronota writes nothing without contacts
+        sys.stderr.write("Voronota version 1.19 command 'draw-contacts' exit error: No input.\n")
+        sys.exit(1)
+
+    parts.append("]\ncmd.load_cgo({0}, '{0}')\ncmd.set('two_sided_lighting', 'on')\n".format(name))
+    with open(option(args, '--drawing-for-pymol'), 'w') as fh:
+        fh.write('from pymol.cgo import *\nfrom pymol import cmd\n')
+        fh.write(''.join(parts))
+
+
+COMMANDS = {
+    'get-balls-from-atoms-file': get_balls,
+    'calculate-contacts': calculate_contacts,
+    'query-contacts': query_contacts,
+    'draw-contacts': draw_contacts,
+}
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in COMMANDS:
+        sys.stderr.write("Unknown command\n")
+        sys.exit(1)
+    COMMANDS[sys.argv[1]](sys.argv[2:])
@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""End-to-end load benchmark of the Vcontacts server.
+
+Starts a copy of the server in a temporary directory with PROGRAM_EXE
+pointing to fake_voronota.py and drives it with concurrent headless
+clients speaking the same protocol as the PyMOL plugin: CHECKFILE,
+SENDFILE when the structure is not there yet, then GETCGO.
+
+    python benchmark/load.py --clients 8 --requests 20
+    python benchmark/load.py --engine asyncio --json results.json
+
+Reports p50/p95/p99 latency of every operation, requests per second and
+memory of the server."""
+
+import os
+import sys
+import json
+import math
+import time
+import random
+import shutil
+import socket
+import hashlib
+import argparse
+import tempfile
+import threading
+import subprocess
+
+try:
+    import configparser
+except ImportError:
+    import ConfigParser as configparser
+
+
+BENCHMARK_DIR = os.path.dirname(os.path.realpath(__file__))
+SERVER_DIR = os.path.join(os.path.dirname(BENCHMARK_DIR), 'Server')
+BUFFER_SIZE = 8192
+
+RESIDUES = ('GLY', 'ALA', 'SER', 'LEU', 'VAL')
+BACKBONE = ('N', 'CA', 'C', 'O')
+ATOM_FORMAT = ('ATOM  {:5d} {:<4s} {:3s} {:1s}{:4d}    '
+               '{:8.3f}{:8.3f}{:8.3f}{:6.2f}{:6.2f}          {:>2s}')
+
+
+def make_pdb(residues, seed):
+    """Two chain structure of backbone atoms, coordinates vary with seed"""
+    rng = random.Random(seed)
+    lines = list()
+    serial = 1
+    for chain, offset in (('A', 0.0), ('B', 9.0)):
+        for number in range(1, residues + 1):
+            name = RESIDUES[number % len(RESIDUES)]
+            for i, atom in enumerate(BACKBONE):
+                angle = (number * 4 + i) * 0.42
+                x = 2.3 * math.cos(angle) + offset + rng.uniform(-0.2, 0.2)
+                y = 2.3 * math.sin(angle) + rng.uniform(-0.2, 0.2)
+                z = (number * 4 + i) * 0.375
+                lines.append(ATOM_FORMAT.format(
+                    serial, ' ' + atom if len(atom) < 4 else atom, name, chain, number,
+                    x, y, z, 1.0, 0.0, atom[0]))
+                serial += 1
+    lines.append('END')
+    return ('\n'.join(lines) + '\n').encode()
+
+
+QUERIES = (
+    ("--match-first 'c<A>' --match-second 'c<B>'", {'--no-solvent': True}),
+    ("--match-first 'c<A>'", {'--no-solvent': True}),
+    ("--match-first 'c<B>&r<1:50>'", {}),
+    ("", {'--no-solvent': True}),
+)
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+class Client(object):
+    """Headless client of the legacy protocol"""
+    def __init__(self, port):
+        self.sock = socket.create_connection(('127.0.0.1', port), timeout=600)
+
+    def recv(self):
+        return self.sock.recv(BUFFER_SIZE).decode()
+
+    def check_file(self, model, pdb):
+        self.sock.sendall('CHECKFILE {} {}'.format(
+            model, hashlib.sha256(pdb).hexdigest()).encode())
+        resp = self.recv()
+        if resp == 'BUSY':
+            raise IOError("Server is busy")
+        return resp == 'OK'
+
+    def send_file(self, model, pdb):
+        self.sock.sendall('SENDFILE {} {}'.format(model, len(pdb)).encode())
+        if self.recv() != 'OK':
+            raise IOError("SENDFILE refused")
+        self.sock.sendall(pdb)
+        if self.recv() != 'OK':
+            raise IOError("SENDFILE failed")
+
+    def get_cgo(self, model, query):
+        self.sock.sendall('GETCGO {}'.format(model).encode())
+        if self.recv() != 'OK':
+            raise IOError("GETCGO: structure not found")
+        query = json.dumps(query).encode()
+        self.sock.sendall(str(len(query)).encode())
+        self.recv()
+        self.sock.sendall(query)
+        resp = self.recv().split(' ')
+        if resp[0] != 'OK':
+            raise IOError("GETCGO failed: {}".format(' '.join(resp)))
+        self.sock.sendall(resp[1].encode())
+        remaining = int(resp[1])
+        data = bytearray()
+        while remaining:
+            slab = self.sock.recv(min(remaining, BUFFER_SIZE))
+            if not slab:
+                raise IOError("Connection closed")
+            data += slab
+            remaining -= len(slab)
+        return json.loads(data.decode())
+
+    def close(self):
+        self.sock.close()
+
+
+def run_client(port, structures, requests, distinct, results, errors, seed):
+    """One client: a connection per request like the plugin makes"""
+    rng = random.Random(seed)
+    for n in range(requests):
+        model, pdb = rng.choice(structures)
+        query, params = rng.choice(QUERIES)
+        params = {'query': dict(params), 'drawing': {'--default-color': 'ffffff'}}
+        if distinct:
+            # unique filter, never answered from the result cache
+            query += " --match-min-area '{}'".format(rng.uniform(0, 1e-3))
+        timings = dict()
+        started = time.time()
+        try:
+            client = Client(port)
+            try:
+                t = time.time()
+                found = client.check_file(model, pdb)
+                timings['CHECKFILE'] = time.time() - t
+                if not found:
+                    t = time.time()
+                    client.send_file(model, pdb)
+                    timings['SENDFILE'] = time.time() - t
+                t = time.time()
+                client.get_cgo(model, {'filter': query, 'params': params})
+                timings['GETCGO'] = time.time() - t
+            finally:
+                client.close()
+        except Exception as e:
+            errors.append(str(e))
+            continue
+        timings['session'] = time.time() - started
+        results.append(timings)
+
+
+def server_memory(pid):
+    """(current, peak) RSS of the server in KiB from /proc, None elsewhere"""
+    values = dict()
+    try:
+        with open('/proc/{}/status'.format(pid)) as fh:
+            for line in fh:
+                key, _, value = line.partition(':')
+                if key in ('VmRSS', 'VmHWM'):
+                    values[key] = int(value.split()[0])
+    except (IOError, OSError):
+        return None, None
+    return values.get('VmRSS'), values.get('VmHWM')
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def prepare_server(directory, args, port):
+    """Copies the server and points its config to fake voronota"""
+    server_dir = os.path.join(directory, 'Server')
+    shutil.copytree(SERVER_DIR, server_dir, ignore=shutil.ignore_patterns(
+        '__pycache__', 'workspace', 'profiles', '*.log'))
+
+    fake = os.path.join(directory, 'voronota')
+    with open(fake, 'w') as fh:
+        fh.write('#!/bin/sh\nexec "{}" "{}" "$@"\n'.format(
+            sys.executable, os.path.join(BENCHMARK_DIR, 'fake_voronota.py')))
+    os.chmod(fake, 0o755)
+
+    config = configparser.ConfigParser(interpolation=None)
+    config.read(os.path.join(server_dir, 'config.ini'))
+    config.set('Server', 'PORT', str(port))
+    config.set('Server', 'ENGINE', args.engine)
+    config.set('Server', 'WORKERS', str(max(args.clients, 1)))
+    config.set('Voronota', 'PROGRAM_EXE', fake)
+    config.set('Voronota', 'QUERY_ENGINE', args.query_engine)
+    with open(os.path.join(server_dir, 'config.ini'), 'w') as fh:
+        config.write(fh)
+    return server_dir
+
+
+def wait_for_port(port, process, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("Server exited with {}".format(process.returncode))
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise RuntimeError("Server did not start in {}s".format(timeout))
+
+
+def report(results, errors, elapsed, memory):
+    requests = sum(len(r) - 1 for r in results)
+    data = {'sessions': len(results), 'requests': requests, 'errors': len(errors),
+            'seconds': round(elapsed, 3),
+            'sessions_per_second': round(len(results) / elapsed, 2),
+            'requests_per_second': round(requests / elapsed, 2),
+            'rss_kib': memory[0], 'peak_rss_kib': memory[1], 'latency': dict()}
+    for op in ('CHECKFILE', 'SENDFILE', 'GETCGO', 'session'):
+        values = [r[op] for r in results if op in r]
+        if values:
+            data['latency'][op] = {
+                'count': len(values),
+                'p50': round(percentile(values, 0.50), 4),
+                'p95': round(percentile(values, 0.95), 4),
+                'p99': round(percentile(values, 0.99), 4),
+                'mean': round(sum(values) / len(values), 4),
+            }
+    return data
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load benchmark of Vcontacts server")
+    parser.add_argument('--clients', type=int, default=8, help="concurrent clients")
+    parser.add_argument('--requests', type=int, default=20, help="requests of every client")
+    parser.add_argument('--structures', type=int, default=4, help="distinct structures")
+    parser.add_argument('--residues', type=int, default=150, help="residues of every chain")
+    parser.add_argument('--engine', default='threads', choices=('threads', 'asyncio'))
+    parser.add_argument('--query-engine', default='native', choices=('native', 'voronota'))
+    parser.add_argument('--distinct', action='store_true',
+                        help="make every query unique so results are not cached")
+    parser.add_argument('--contacts-delay', type=float, default=1.0,
+                        help="seconds fake voronota takes to calculate contacts")
+    parser.add_argument('--delay', type=float, default=0.05,
+                        help="seconds other fake voronota commands take")
+    parser.add_argument('--neighbours', type=int, default=8, help="contacts of every atom")
+    parser.add_argument('--vertices', type=int, default=12, help="vertices of every contact")
+    parser.add_argument('--json', help="also write results to this file")
+    parser.add_argument('--keep', action='store_true', help="keep temporary server directory")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='vcontacts-bench-')
+    port = free_port()
+    server_dir = prepare_server(directory, args, port)
+    env = dict(os.environ,
+               FAKE_VORONOTA_CONTACTS_DELAY=str(args.contacts_delay),
+               FAKE_VORONOTA_DELAY=str(args.delay),
+               FAKE_VORONOTA_NEIGHBOURS=str(args.neighbours),
+               FAKE_VORONOTA_VERTICES=str(args.vertices))
+    with open(os.path.join(directory, 'server.out'), 'w') as log:
+        process = subprocess.Popen([sys.executable, 'server.py'], cwd=server_dir,
+                                   env=env, stdout=log, stderr=subprocess.STDOUT)
+    try:
+        wait_for_port(port, process)
+        structures = [('bench{}'.format(i), make_pdb(args.residues, i))
+                      for i in range(args.structures)]
+        results, errors = list(), list()
+        threads = [threading.Thread(target=run_client, args=(
+            port, structures, args.requests, args.distinct, results, errors, i))
+            for i in range(args.clients)]
+
+        started = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - started
+        data = report(results, errors, elapsed, server_memory(process.pid))
+    finally:
+        process.terminate()
+        process.wait()
+        if not args.keep:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    print("{} sessions ({} requests) by {} clients in {:.2f}s, {} errors".format(
+        data['sessions'], data['requests'], args.clients, data['seconds'],
+        data['errors']))
+    print("{} requests/s, {} sessions/s".format(
+        data['requests_per_second'], data['sessions_per_second']))
+    print("{:10} {:>6} {:>9} {:>9} {:>9} {:>9}".format(
+        'operation', 'count', 'p50', 'p95', 'p99', 'mean'))
+    for op, values in data['latency'].items():
+        print("{:10} {:>6} {:>8.3f}s {:>8.3f}s {:>8.3f}s {:>8.3f}s".format(
+            op, values['count'], values['p50'], values['p95'], values['p99'], values['mean']))
+    if data['rss_kib'] is not None:
+        print("server RSS {} KiB, peak {} KiB".format(data['rss_kib'], data['peak_rss_kib']))
+    if errors:
+        print("first error: {}".format(errors[0]))
+    if args.keep:
+        print("server directory kept in {}".format(directory))
+
+    if args.json:
+        with open(args.json, 'w') as fh:
+            json.dump(data, fh, indent=2)
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
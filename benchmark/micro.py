@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Microbenchmarks of client and server helpers on synthetic inputs.
+
+Runs without PyMOL: client helpers are taken from the source of
+Client/Vcontacts.py without importing the plugin.
+
+    python benchmark/micro.py
+    python benchmark/micro.py --only compress_atoms --repeat 10
+    python benchmark/micro.py --update
+
+Best time of every benchmark is compared with benchmark/baseline.json,
+exits with 1 if any is slower than baseline by more than --threshold.
+--scale multiplies input sizes (--scale 64 makes multi-GB contacts text),
+baselines are only compared at the scale they were recorded at."""
+
+import os
+import sys
+import ast
+import json
+import time
+import random
+import shutil
+import hashlib
+import argparse
+import platform
+import tempfile
+
+BENCHMARK_DIR = os.path.dirname(os.path.realpath(__file__))
+ROOT_DIR = os.path.dirname(BENCHMARK_DIR)
+BASELINE_FILE = os.path.join(BENCHMARK_DIR, 'baseline.json')
+
+sys.path.insert(0, os.path.join(ROOT_DIR, 'Server'))
+from lib import ContactIndex, Voronota, Workspace
+
+# functions of Client/Vcontacts.py which don't need PyMOL
+CLIENT_FUNCTIONS = (
+    'compress_atoms', 'Generic', 'Float', 'Int', 'compose',
+    'append_to_local_output', 'append_to_global_output',
+)
+
+ATOMS = 200000
+MB = 1024 * 1024
+
+
+def client_helpers():
+    """Namespace with CLIENT_FUNCTIONS compiled from the plugin source"""
+    file_name = os.path.join(ROOT_DIR, 'Client', 'Vcontacts.py')
+    with open(file_name) as fh:
+        tree = ast.parse(fh.read(), file_name)
+    body = [node for node in tree.body if isinstance(node, ast.FunctionDef)
+            and node.name in CLIENT_FUNCTIONS]
+    namespace = dict()
+    exec(compile(ast.Module(body=body, type_ignores=[]), file_name, 'exec'), namespace)
+    return namespace
+
+
+def atom_ids(count, seed=1):
+    """Shuffled serials of a structure with a few gaps, like a selection
+    of 'count' atoms from PyMOL"""
+    rng = random.Random(seed)
+    ids, serial = list(), 1
+    while len(ids) < count:
+        serial += 1 if rng.random() > 0.02 else rng.randint(2, 40)
+        ids.append(serial)
+    rng.shuffle(ids)
+    return ids
+
+
+def descriptor(atom):
+    return 'c<{}>r<{}>a<{}>R<ALA>A<{}>'.format(
+        'AB'[atom % 2], atom // 8, atom, ('N', 'CA', 'C', 'O', 'CB')[atom % 5])
+
+
+def write_lines(file_name, size, line):
+    """Writes lines made by line(rng, n) until file has size bytes"""
+    rng = random.Random(2)
+    written, n = 0, 0
+    with open(file_name, 'wb') as fh:
+        while written < size:
+            block = ''.join(line(rng, n + i) for i in range(10000)).encode()
+            fh.write(block)
+            written += len(block)
+            n += 10000
+
+
+def summarized_line(rng, n):
+    return '{} c<any> {:.6g} {:.6g} . .\n'.format(
+        descriptor(n), rng.uniform(0, 60), rng.uniform(2, 6))
+
+
+def contact_line(rng, n):
+    # atoms have about 8 contacts each
+    return '{} {} {:.6g} {:.6g} . .\n'.format(
+        descriptor(n // 8), descriptor(n // 8 + rng.randint(1, 400)),
+        rng.uniform(0, 30), rng.uniform(2, 6))
+
+
+# Every benchmark is set up with (scale, directory) and returns
+# (function to time, units it processes, name of the unit)
+
+def bench_compress_atoms(scale, directory):
+    helpers = client_helpers()
+    ids = atom_ids(ATOMS * scale)
+    return lambda: helpers['compress_atoms'](list(ids)), len(ids), 'atoms'
+
+
+def bench_serials(scale, directory):
+    """get_serials without cmd.iterate: ranges joined to a selection"""
+    helpers = client_helpers()
+    ids = atom_ids(ATOMS * scale)
+    return (lambda: ' '.join(helpers['compress_atoms'](list(ids))),
+            len(ids), 'atoms')
+
+
+def bench_compose(scale, directory):
+    helpers = client_helpers()
+    compress_atoms = helpers['compress_atoms']
+    left = ' '.join(compress_atoms(atom_ids(ATOMS * scale, 3)))
+    right = ' '.join(compress_atoms(atom_ids(ATOMS * scale, 4)))
+    args = ['A B', '1:500', 'ALA GLY', left, 'CA CB',
+            'C', '', '', '', '',
+            'B', '', '', right, '',
+            '', '700:800', 'HOH', '', 'H',
+            '0.5', '', '', '5', '1', '']
+    calls = 20
+
+    def run():
+        for _ in range(calls):
+            helpers['compose'](*args)
+    return run, calls * (len(left) + len(right)), 'bytes'
+
+
+def bench_checksum(scale, directory):
+    """Workspace.file_check_checksum of a structure not in checksum index"""
+    size = 64 * MB * scale
+    Workspace.SERVER_DIR = directory
+    Workspace.DISK_QUOTA = 0
+    data = os.urandom(MB) * (size // MB)
+    digest = hashlib.sha256(data).hexdigest()
+    os.mkdir(os.path.join(directory, digest))
+    with open(Workspace.structure_file(digest), 'wb') as fh:
+        fh.write(data)
+
+    def run():
+        Workspace._checksums = dict()
+        assert Workspace.file_check_checksum(digest)
+    return run, size, 'bytes'
+
+
+def bench_checksum_indexed(scale, directory):
+    """Workspace.file_check_checksum of a structure in checksum index"""
+    calls = 20000 * scale
+    Workspace.SERVER_DIR = directory
+    Workspace.DISK_QUOTA = 0
+    data = b'ATOM\n' * 1000
+    digest = hashlib.sha256(data).hexdigest()
+    os.mkdir(os.path.join(directory, digest))
+    with open(Workspace.structure_file(digest), 'wb') as fh:
+        fh.write(data)
+    Workspace._checksums = dict()
+    Workspace.record_checksum(digest)
+
+    def run():
+        for _ in range(calls):
+            Workspace.file_check_checksum(digest)
+    return run, calls, 'calls'
+
+
+def bench_summarize(scale, directory):
+    """Voronota.summarize parser of query-contacts --summarize-by-first"""
+    size = 32 * MB * scale
+    file_name = os.path.join(directory, 'summarized')
+    write_lines(file_name, size, summarized_line)
+
+    def run():
+        with open(file_name, 'rb') as fh:
+            Voronota.summarize_stream(fh)
+    return run, os.path.getsize(file_name), 'bytes'
+
+
+def bench_summary_stream(scale, directory):
+    """ContactIndex.Summary of query-contacts output drawn by voronota"""
+    size = 32 * MB * scale
+    file_name = os.path.join(directory, 'contacts')
+    write_lines(file_name, size, contact_line)
+    query = ContactIndex.parse_query(['--match-first', 'c<A>'])
+
+    def run():
+        summary = ContactIndex.Summary(query)
+        with open(file_name, 'rb') as fh:
+            for block in iter(lambda: fh.read(ContactIndex.BLOCK_SIZE), b''):
+                summary.feed(block)
+        summary.result()
+    return run, os.path.getsize(file_name), 'bytes'
+
+
+BENCHMARKS = (
+    ('compress_atoms', bench_compress_atoms),
+    ('serials', bench_serials),
+    ('compose', bench_compose),
+    ('checksum', bench_checksum),
+    ('checksum_indexed', bench_checksum_indexed),
+    ('summarize', bench_summarize),
+    ('summary_stream', bench_summary_stream),
+)
+
+
+def measure(function, repeat):
+    """Best wall time of repeat runs"""
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def rate(units, seconds, unit):
+    if unit == 'bytes':
+        return '{:.1f} MB/s'.format(units / seconds / MB)
+    return '{:.0f} {}/s'.format(units / seconds, unit)
+
+
+def load_baseline():
+    if not os.path.isfile(BASELINE_FILE):
+        return None
+    with open(BASELINE_FILE) as fh:
+        return json.load(fh)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks of Vcontacts helpers")
+    parser.add_argument('--only', action='append', choices=[n for n, _ in BENCHMARKS],
+                        help="run only this benchmark, can be repeated")
+    parser.add_argument('--repeat', type=int, default=5, help="runs of every benchmark")
+    parser.add_argument('--scale', type=int, default=1, help="multiplier of input sizes")
+    parser.add_argument('--threshold', type=float, default=0.3,
+                        help="allowed slowdown against baseline, 0.3 is 30%%")
+    parser.add_argument('--update', action='store_true',
+                        help="store results as the new baseline")
+    args = parser.parse_args()
+
+    baseline = load_baseline()
+    if baseline is not None and baseline.get('scale') != args.scale:
+        print("Baseline was recorded at scale {}, not compared".format(baseline.get('scale')))
+        baseline = None
+    previous = baseline['seconds'] if baseline else dict()
+
+    results, regressions = dict(), list()
+    print("{:18} {:>10} {:>10} {:>8} {:>14}".format(
+        'benchmark', 'seconds', 'baseline', 'ratio', 'rate'))
+    for name, setup in BENCHMARKS:
+        if args.only and name not in args.only:
+            continue
+        directory = tempfile.mkdtemp(prefix='vcontacts-micro-')
+        try:
+            function, units, unit = setup(args.scale, directory)
+            seconds = results[name] = measure(function, args.repeat)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+        line = "{:18} {:>10.4f}".format(name, seconds)
+        if name in previous:
+            ratio = seconds / previous[name]
+            line += " {:>10.4f} {:>8.2f}".format(previous[name], ratio)
+            if ratio > 1 + args.threshold:
+                regressions.append(name)
+                line += ' REGRESSION'
+        else:
+            line += " {:>10} {:>8}".format('-', '-')
+        print(line + " {:>14}".format(rate(units, seconds, unit)))
+
+    if args.update:
+        data = {'scale': args.scale,
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'seconds': dict(previous, **{n: round(s, 6) for n, s in results.items()})}
+        with open(BASELINE_FILE, 'w') as fh:
+            json.dump(data, fh, indent=2, sort_keys=True)
+            fh.write('\n')
+        print("Baseline saved to {}".format(BASELINE_FILE))
+        return 0
+
+    if regressions:
+        print("Slower than baseline by more than {:.0%}: {}".format(
+            args.threshold, ', '.join(regressions)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())